@@ -3,7 +3,8 @@
 import os
 import sys
 import subprocess
-from github import Github, GithubException
+from github import GithubException
+from github.Repository import Repository
 import configparser
 import re
 import shutil
@@ -13,8 +14,20 @@ from pathlib import Path
 import datetime
 import subprocess
 import json
+import time
+import random
+import functools
+import signal
+import tempfile
+import hashlib
+import fnmatch
+import gzip
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import argparse
+from similarity import winnow, corpus
+from similarity.template import TemplateSubtractor
+import ghclient
 # Try to get it from system environment variable (On Linux/macOS you have to create it on $HOME/.bash_profile or .bashrc)
 _key = os.environ.get('GIT_TOKEN', None)
 _parent = os.environ.get('PARENT_REPO', None)
@@ -35,6 +48,11 @@ if _key is None:
     if 'RUN_REMOTE_PASSWORD' in _config_parser['DEFAULT'].keys():
         _run_remote_password = _config_parser['DEFAULT']['RUN_REMOTE_PASSWORD']
 
+# Optional tuning knobs. Unlike the token these are always read from config.ini.
+_settings = configparser.ConfigParser()
+_settings.read('config.ini')
+_settings = _settings['DEFAULT']
+
 GIT_CONFIG = {
     'key': _key,
     # Set name of owner and TAs,
@@ -58,7 +76,55 @@ GIT_CONFIG = {
 
     'failed': 'Result: FAIL',
 
-    'run_remote_password': _run_remote_password
+    'run_remote_password': _run_remote_password,
+
+    # Local state (repo index, caches) lives here, relative to the cwd.
+    'index_dir': _settings.get('INDEX_DIR', '.gcassist'),
+
+    # Seconds for which the repo index is trusted without revalidation.
+    'index_ttl': int(_settings.get('REPO_INDEX_TTL', '60')),
+
+    # Parallel git workers used by clone.
+    'clone_jobs': int(_settings.get('CLONE_JOBS', '8')),
+
+    # Parallel git workers, and retries of transient failures, for pushes.
+    'push_jobs': int(_settings.get('PUSH_JOBS', '8')),
+    'push_retries': int(_settings.get('PUSH_RETRIES', '4')),
+
+    # Parallel GitHub API calls, e.g. permission changes.
+    'api_jobs': int(_settings.get('API_JOBS', '16')),
+
+    # run-remote: grading runs kept in flight (0: one per online runner),
+    # seconds between polls, and seconds to wait for a dispatched run to start.
+    'dispatch_inflight': int(_settings.get('DISPATCH_INFLIGHT', '0')),
+    'dispatch_poll': int(_settings.get('DISPATCH_POLL', '30')),
+    'dispatch_start_timeout': int(_settings.get('DISPATCH_START_TIMEOUT', '600')),
+
+    # Skip repos an interrupted push run already finished.
+    'push_resume': True,
+
+    # run-local: parallel jobs, wall-clock timeout (s), CPU time (s),
+    # address space (MB), process count and file size (MB) limits per repo.
+    # 0 disables.
+    'run_jobs': int(_settings.get('RUN_JOBS', str(os.cpu_count() or 1))),
+    'run_timeout': int(_settings.get('RUN_TIMEOUT', '1200')),
+    'run_cpu_limit': int(_settings.get('RUN_CPU_LIMIT', '900')),
+    'run_mem_limit': int(_settings.get('RUN_MEM_LIMIT', '4096')),
+    'run_nproc_limit': int(_settings.get('RUN_NPROC_LIMIT', '4096')),
+    'run_file_limit': int(_settings.get('RUN_FILE_LIMIT', '1024')),
+
+    # KB kept from the start and from the end of each run-local log.
+    'log_head': int(_settings.get('LOG_HEAD_KB', '256')),
+    'log_tail': int(_settings.get('LOG_TAIL_KB', '256')),
+
+    # Reuse run-local results of repos whose HEAD and harness are unchanged.
+    'run_cache': True,
+
+    # JSON file with the compile-check rules; see load_compile_rules.
+    'compile_rules': _settings.get('COMPILE_RULES', 'compile_rules.json'),
+
+    # Cross-term fingerprint corpora used by similarity.
+    'corpus_dir': _settings.get('CORPUS_DIR', '.gcassist/corpus')
 }
 
 
@@ -80,6 +146,7 @@ def print_help():
     print("    ls (list) ")
     print("    push-comment")
     print("    moss")
+    print("    similarity")
     print("    push-pass-fail")
     print("    clone")
     print("    cancel-remote")
@@ -88,6 +155,7 @@ def print_help():
     print("    set_remove")
     print("    push-grade-sheet")
     print("    run-local")
+    print("    grep-logs")
     print("    run-remote")
     print("    add-commit")
     print("    force-remove-runners")
@@ -119,6 +187,138 @@ def is_matching(repo, project, organization):
     return False
 
 
+def fetch_org_repos(organization):
+    '''
+    Lists the raw repository records of an organization, backed by an
+    on-disk index in GIT_CONFIG['index_dir'].
+
+    Pages of /orgs/<org>/repos go through the shared HTTP cache (see
+    ghclient), so unchanged pages are revalidated with a 304, which GitHub
+    does not count against the rate limit. Within GIT_CONFIG['index_ttl']
+    seconds of the last check the index is trusted without any request at
+    all.
+
+    Parameters:
+        - Organization name which owns the repos
+
+    Returns:
+        - List of repository dicts as returned by the GitHub REST API
+    '''
+    index_path = os.path.join(GIT_CONFIG['index_dir'],
+                              f"repos-{organization}.json")
+    index = {'checked': 0, 'repos': []}
+    if os.path.isfile(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+
+    if time.time() - index['checked'] < GIT_CONFIG['index_ttl'] and 'repos' in index:
+        return index['repos']
+
+    session = ghclient.session(GIT_CONFIG['key'])
+    # Newest first: a new repo shifts every page, so no stale page survives.
+    url = (f"https://api.github.com/orgs/{organization}/repos"
+           "?type=all&sort=created&direction=desc&per_page=100")
+    repos = []
+    pages = 0
+    fetched = 0
+    while url:
+        response = session.get(url)
+        response.raise_for_status()
+        pages += 1
+        fetched += not response.from_cache
+        repos += response.json()
+        url = response.links.get('next', {}).get('url')
+
+    index = {'checked': time.time(), 'repos': repos}
+    pathlib.Path(GIT_CONFIG['index_dir']).mkdir(parents=True, exist_ok=True)
+    with open(index_path + ".tmp", "w") as f:
+        json.dump(index, f)
+    os.replace(index_path + ".tmp", index_path)
+    print(f"Repo index for {organization}: {pages} pages, "
+          f"{fetched} changed", file=sys.stderr)
+
+    return repos
+
+
+def matching_repos(g, project, organization):
+    '''
+    Finds the repositories matching a project within an organization.
+    Replaces walking g.get_user().get_repos(), which lists every repo the
+    token can see across all orgs and terms.
+
+    Parameters:
+        - G is the Github client used to build the repository objects
+        - Project name to be queried (repo name should contain this)
+        - Organization name which should own the repo
+
+    Returns:
+        - List of matching github Repository objects
+    '''
+    repos = []
+    for raw in fetch_org_repos(organization):
+        repo = g.create_from_raw_data(Repository, raw)
+        if is_matching(repo, project, organization):
+            repos.append(repo)
+    return repos
+
+
+# Push failures worth retrying: network trouble and server-side errors.
+# Anything else (rejected push, auth failure) fails immediately.
+_TRANSIENT_GIT_ERRORS = re.compile(
+    r"Could not resolve host|Connection (reset|refused|timed out)|"
+    r"timed out|early EOF|RPC failed|remote end hung up|"
+    r"returned error: 5\d\d|HTTP 5\d\d|SSL|TLS|unable to access",
+    re.IGNORECASE)
+
+
+def git_push_retry(cwd):
+    '''
+    Pushes to remote, retrying transient failures with exponential backoff
+    (up to GIT_CONFIG['push_retries'] retries).
+
+    Parameters:
+        - Cwd is the directory path of the repo
+
+    Returns:
+        - Tuple of (status, detail) where status is 'pushed', 'no-op'
+          (remote already up to date) or 'failed'
+    '''
+    for attempt in range(GIT_CONFIG['push_retries'] + 1):
+        p = git_quiet(["push"], cwd)
+        if p.returncode == 0:
+            if "Everything up-to-date" in p.stderr:
+                return "no-op", ""
+            return "pushed", ""
+        if not _TRANSIENT_GIT_ERRORS.search(p.stderr):
+            break
+        time.sleep(min(60, 2 ** attempt) + random.random())
+    return "failed", p.stderr.strip()
+
+
+def git_commit_push(cwd, commit_msg):
+    '''
+    Commits whatever is staged and pushes it, skipping the commit when
+    nothing is staged and the push when the branch is not ahead of its
+    upstream. Both checks are local, so untouched repos cost no round trip.
+
+    Parameters:
+        - Cwd is the directory path of the repo
+        - Commit_msg is the message used if there is something to commit
+
+    Returns:
+        - Tuple of (status, detail); see git_push_retry
+    '''
+    if git_quiet(["diff", "--cached", "--quiet"], cwd).returncode != 0:
+        p = git_quiet(["commit", "-m", commit_msg], cwd)
+        if p.returncode != 0:
+            return "failed", (p.stdout + p.stderr).strip()
+    p = git_quiet(["rev-list", "--count", "@{u}..HEAD"], cwd)
+    # Without an upstream to compare against, let the push decide.
+    if p.returncode == 0 and p.stdout.strip() == "0":
+        return "no-op", ""
+    return git_push_retry(cwd)
+
+
 def git_add_commit_push(result, cwd, commit_msg):
     '''
     Adds, commits and pushes file to remote.
@@ -128,58 +328,195 @@ def git_add_commit_push(result, cwd, commit_msg):
         - Cwd is the directory path of the repo where the file is located
 
     Returns:
-        - None
+        - Tuple of (status, detail); see git_push_retry
     '''
     commit_msg = commit_msg.format(result)
-    subprocess.run(["git", "add", result], cwd=cwd)
-    subprocess.run(["git", "commit", "-m", commit_msg], cwd=cwd)
-    subprocess.run(["git", "push"], cwd=cwd)
+    git_quiet(["add", result], cwd)
+    return git_commit_push(cwd, commit_msg)
 
 
 def git_pull_template_commit(parent, cwd):
     '''
-    Adds, commits and pushes file to remote.
+    Merges master of the template remote, commits and pushes to remote.
 
     Parameters:
-        - Result of the file to be added to the repo and pushed
-        - Cwd is the directory path of the repo where the file is located
+        - Parent is the url (or local store) of the template repo
+        - Cwd is the directory path of the repo
 
     Returns:
-        - None
+        - Tuple of (status, detail); see git_push_retry
     '''
-    subprocess.run(["git", "remote", "add", "template", parent], cwd=cwd)
-    subprocess.run(
-        ["git", "fetch", "--all"], cwd=cwd)
-    subprocess.run(["git", "merge", "template/master",
-                    "--allow-unrelated-histories"], cwd=cwd)
-    subprocess.run(["git", "add", "."], cwd=cwd)
-    subprocess.run(
-        ["git", "commit", "-am", "Pulling changes from forked master"], cwd=cwd)
-    subprocess.run(["git", "push"], cwd=cwd)
+    git_quiet(["remote", "add", "template", parent], cwd)
+    # The remote may be left over from a run against a different url.
+    git_quiet(["remote", "set-url", "template", parent], cwd)
+    p = git_quiet(["fetch", "--all"], cwd)
+    if p.returncode != 0:
+        return "failed", p.stderr.strip()
+    p = git_quiet(["merge", "template/master", "--no-edit",
+                   "--allow-unrelated-histories"], cwd)
+    if p.returncode != 0:
+        git_quiet(["merge", "--abort"], cwd)
+        return "failed", (p.stdout + p.stderr).strip()
+    git_quiet(["add", "."], cwd)
+    return git_commit_push(cwd, "Pulling changes from forked master")
 
 
 def git_pull_fork_commit(parent, cwd):
     '''
-    Adds, commits and pushes file to remote.
+    Pulls master of the parent fork, commits and pushes to remote.
 
     Parameters:
-        - Result of the file to be added to the repo and pushed
-        - Cwd is the directory path of the repo where the file is located
+        - Parent is the url (or local store) of the parent repo
+        - Cwd is the directory path of the repo
+
+    Returns:
+        - Tuple of (status, detail); see git_push_retry
+    '''
+    p = git_quiet(["pull", "--no-edit", parent, "master"], cwd)
+    if p.returncode != 0:
+        git_quiet(["merge", "--abort"], cwd)
+        return "failed", (p.stdout + p.stderr).strip()
+    git_quiet(["add", "."], cwd)
+    return git_commit_push(cwd, "Pulling changes from forked master")
+
+
+def print_summary(results, problems=("failed",)):
+    '''
+    Prints how many repos ended in each status, and why the failed ones did.
+
+    Parameters:
+        - Results is a dict of repo name -> (status, detail)
+        - Problems are the statuses whose detail is printed
 
     Returns:
         - None
     '''
-    subprocess.run(["git", "pull", parent, "master"], cwd=cwd)
-    subprocess.run(["git", "add", "."], cwd=cwd)
-    subprocess.run(
-        ["git", "commit", "-am", "Pulling changes from forked master"], cwd=cwd)
-    subprocess.run(["git", "push"], cwd=cwd)
+    counts = {}
+    for status, _ in results.values():
+        counts[status] = counts.get(status, 0) + 1
+    print("Summary: " + ", ".join(f"{n} {status}"
+                                  for status, n in sorted(counts.items())))
+    for name, (status, detail) in sorted(results.items()):
+        if status in problems:
+            print(f"    {name}: {status} {detail.splitlines()[-1] if detail else ''}")
+
+
+def push_journal_path(name):
+    return os.path.join(GIT_CONFIG['index_dir'], f"push-{name}.journal")
+
+
+def content_digest(*parts):
+    '''
+    Hashes what a push task is about to commit (e.g., a grading comment),
+    so the journal can tell a finished repo from one whose content changed.
+    '''
+    h = hashlib.sha1()
+    for part in parts:
+        h.update(str(part).encode("utf-8", "surrogateescape") + b"\0")
+    return h.hexdigest()
+
+
+def worktree_digest(repo_dir):
+    '''
+    Hashes the uncommitted changes of a repo: the changed paths with their
+    size and modification time, so editing a file again changes the digest.
+    '''
+    p = git_quiet(["status", "--porcelain", "-z", "--untracked-files=all"], repo_dir)
+    parts = [p.stdout]
+    for entry in p.stdout.split("\0"):
+        path = os.path.join(repo_dir, entry[3:])
+        if len(entry) > 3 and os.path.isfile(path):
+            st = os.stat(path)
+            parts.append(f"{entry[3:]}:{st.st_size}:{st.st_mtime_ns}")
+    return content_digest(*parts)
+
+
+def read_push_journal(name):
+    '''
+    Reads the repos a previous, interrupted push run already finished.
+
+    Parameters:
+        - Name identifies the run (action and project)
+
+    Returns:
+        - Dict of repo name -> content digest (or None) of the repos that
+          were pushed or were a no-op
+    '''
+    done = {}
+    path = push_journal_path(name)
+    if GIT_CONFIG['push_resume'] and os.path.isfile(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Torn last line from a killed run.
+                    continue
+                if entry['status'] in ("pushed", "no-op"):
+                    done[entry['repo']] = entry.get('digest')
+    return done
+
+
+def push_pipeline(name, tasks, digests=None):
+    '''
+    Runs per-repo commit/push tasks on GIT_CONFIG['push_jobs'] workers.
+    Every finished repo is appended to a journal with the digest of its
+    content, so an interrupted run started again with the same name skips
+    repos that already made it, unless their content changed since.
+    The journal is removed once a run finishes without failures.
+
+    Parameters:
+        - Name identifies the run (action and project)
+        - Tasks is a dict of repo name -> callable returning (status, detail)
+        - Digests is a dict of repo name -> digest of what the task pushes
+          (see content_digest)
+
+    Returns:
+        - Dict of repo name -> (status, detail)
+    '''
+    digests = digests or {}
+    done = read_push_journal(name)
+    pending = {repo: task for repo, task in tasks.items()
+               if repo not in done or done[repo] != digests.get(repo)}
+    changed = sum(1 for repo in pending if repo in done)
+    if len(pending) < len(tasks) or changed:
+        print(f"Resuming: {len(tasks) - len(pending)} repos were done "
+              f"by a previous run, {changed} changed since and are pushed again")
+
+    pathlib.Path(GIT_CONFIG['index_dir']).mkdir(parents=True, exist_ok=True)
+    path = push_journal_path(name)
+    results = {}
+    with open(path, "a" if GIT_CONFIG['push_resume'] else "w") as journal, \
+            ThreadPoolExecutor(max_workers=GIT_CONFIG['push_jobs']) as pool:
+        futures = {pool.submit(task): repo for repo, task in pending.items()}
+        for n, future in enumerate(as_completed(futures), 1):
+            repo = futures[future]
+            try:
+                status, detail = future.result()
+            except Exception as e:
+                status, detail = "failed", str(e)
+            results[repo] = (status, detail)
+            journal.write(json.dumps({'repo': repo, 'status': status,
+                                      'digest': digests.get(repo)}) + "\n")
+            journal.flush()
+            print(f"[{n}/{len(futures)}] {repo}: {status}")
+
+    print_summary(results)
+    touched = sum(1 for status, _ in results.values() if status == "pushed")
+    print(f"Touched {touched} of {len(tasks)} repos")
+    if all(status != "failed" for status, _ in results.values()):
+        os.remove(path)
+    return results
 
 
 def parse_markdown_grading_sheeet(filename):
     '''
     Parses a markdown file for names and matches them with comments.
 
+    A header may name several students, separated by commas (a cluster
+    written by log2gradingtemplate.py --cluster). Each of them gets the
+    comment under a header with only their own name.
+
     Parameters:
         - Filename of the markdown file to be parsed
 
@@ -192,22 +529,31 @@ def parse_markdown_grading_sheeet(filename):
         return None
 
     grading_sheet = dict()
-    student_name = None
+    student_names = []
     student_content = ""
 
+    def add_section():
+        for student_name in student_names:
+            header = student_content.split("\n", 1)
+            if len(student_names) > 1:
+                header[0] = "### " + student_name
+            grading_sheet[student_name] = "\n".join(header)
+
     with open(filename, "r") as markdown_file:
         for line in markdown_file:
-            # New student, so add previous student to dict
+            # New student(s), so add previous section to dict
             if line.startswith("### "):
-                if student_name is not None:
-                    grading_sheet[student_name] = student_content
-                student_name = line.strip("# \n")
+                add_section()
+                # Only commas separate names; anything else is part of the
+                # name, as for a single-student header.
+                student_names = [name.strip() for name in line.strip("# \n").split(",")
+                                 if name.strip()]
                 student_content = line
             # Same student, concatenate content
             else:
                 student_content = student_content + line
 
-        grading_sheet[student_name] = student_content
+        add_section()
 
     return grading_sheet
 
@@ -247,6 +593,14 @@ def add_commit_push_grading_sheet():
     repos = os.listdir(project_dir)
     result = GIT_CONFIG['grading_file']
 
+    def grade(repo_dir, comment):
+        with open(f"{repo_dir}/{result}", "w+") as f:
+            f.write(comment)
+        return git_add_commit_push(
+            result, repo_dir, 'Graded project, see the {}-file in the root directory'.format(result))
+
+    tasks = {}
+    digests = {}
     for repo in repos:
         repo_dir = "{}/{}".format(project_dir, repo)
         if os.path.isdir(repo_dir):
@@ -257,17 +611,16 @@ def add_commit_push_grading_sheet():
                     found_student = True
                     print(f"Assuming {repo} belongs to {student_name}: "
                           "adding grading comment")
-                    with open(f"{repo_dir}/{result}", "w+") as f:
-                        f.write(grading_sheet[student_name])
+                    tasks[repo] = functools.partial(
+                        grade, repo_dir, grading_sheet[student_name])
+                    digests[repo] = content_digest(grading_sheet[student_name])
                     break
 
-            if found_student:
-                git_add_commit_push(
-                    result, repo_dir, 'Graded project, see the {}-file in the root directory'.format(result))
-                print("Pushed changes to github")
-            else:
+            if not found_student:
                 print(f"Found no student matching repo name {repo}")
 
+    push_pipeline(f"push-grade-sheet-{project}", tasks, digests)
+
 
 def add_commit_push(project, comment):
     '''
@@ -289,10 +642,16 @@ def add_commit_push(project, comment):
         passed = GIT_CONFIG['passed']
         failed = GIT_CONFIG['failed']
 
+    name = f"push-{'comment' if comment else 'pass-fail'}-{project}"
+    done = read_push_journal(name)
     project_dir = "{}/{}".format(os.getcwd(), project)
     repos = os.listdir(project_dir)
+    tasks = {}
+    digests = {}
     for repo in repos:
         repo_dir = "{}/{}".format(project_dir, repo)
+        if repo in done:
+            continue
         if os.path.isdir(repo_dir):
             if not comment:
                 inp = input(f"Did {repo} 'pass' or 'fail'? [Default: pass]: ")
@@ -311,43 +670,231 @@ def add_commit_push(project, comment):
             with open(f"{repo_dir}/{result}", "w+") as f:
                 f.write(text)
 
-            git_add_commit_push(
-                result, repo_dir, 'Graded project, see the {}-file in the root directory'.format(result))
-            print("Pushed changes to github")
+            # Pushes are batched after the last prompt
+            tasks[repo] = functools.partial(
+                git_add_commit_push, result, repo_dir, 'Graded project, see the {}-file in the root directory'.format(result))
+            digests[repo] = content_digest(result, text)
         else:
             print(f"\n{repo} is not a directory, and can't be a repo")
 
+    push_pipeline(name, tasks, digests)
+
+
+def manifest_matcher(names):
+    '''
+    Compiles a file manifest into a predicate on base names. Plain names
+    are looked up in a set; entries with glob characters (e.g., *.s) are
+    folded into a single regular expression.
+
+    Parameters:
+        - Names is the list of file names or patterns
+
+    Returns:
+        - Function taking a base name and returning True if it is listed
+    '''
+    plain = frozenset(n for n in names if not re.search(r"[*?[]", n))
+    patterns = [fnmatch.translate(n) for n in names if re.search(r"[*?[]", n)]
+    regex = re.compile("|".join(patterns)) if patterns else None
+    return lambda name: name in plain or (
+        regex is not None and regex.match(name) is not None)
+
+
+def repo_files(repo_dir, head, index):
+    '''
+    Lists the files of a repo, reusing the file index while HEAD is the same.
+    Tracked files come from git ls-files, which reads the git index instead
+    of walking the tree; directories that are not repos are walked.
+
+    Parameters:
+        - Repo_dir is the repo checkout
+        - Head is its HEAD commit, or None if it is not a repo
+        - Index is a dict of repo_dir -> {'head', 'files'}, updated in place
 
-def moss(project, comment):
+    Returns:
+        - List of paths relative to repo_dir
+    '''
+    entry = index.get(repo_dir)
+    if head and entry and entry['head'] == head:
+        return entry['files']
+    if head:
+        p = git_quiet(["ls-files", "-z"], repo_dir)
+        files = [f for f in p.stdout.split("\0") if f]
+    else:
+        files = []
+        for root, dirs, names in os.walk(repo_dir):
+            dirs[:] = [d for d in dirs if d != ".git"]
+            files += [os.path.relpath(os.path.join(root, n), repo_dir)
+                      for n in names]
+    index[repo_dir] = {'head': head, 'files': files}
+    return files
+
+
+def link_or_copy(src, dst):
+    '''
+    Stages a file without copying its bytes where possible: a hardlink,
+    else a reflink (copy-on-write clone, e.g. on btrfs or XFS), else a copy.
+    An existing dst is replaced.
+    '''
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+        return
+    except OSError:
+        pass
+    if subprocess.run(["cp", "--reflink=auto", src, dst],
+                      capture_output=True).returncode != 0:
+        shutil.copyfile(src, dst)
+
+
+def moss(project, comment, subtractor=None, manifest=None, incremental=True):
     '''
     Obtain a file, and set it up in the appropriate student directory
 
+    Files are hardlinked (or reflinked) into Mossbox/<githubid> rather than
+    copied. Mossbox/.staged.json records the HEAD each student directory
+    was staged from, so by default only repos whose HEAD moved, or whose
+    manifest or template changed, are staged again. The file list of each
+    repo is kept in .gcassist/files-<project>.json, so staging another
+    manifest of the same assignment does not rescan the repos.
+
     Parameters:
         - Project which should match the name of the sub-directory containing
           the git repositories which should be added, committed and pushed to.
         - Comment parameter determines if the commit should be a comment or not
+        - Subtractor (a TemplateSubtractor) if only student-authored lines
+          should be staged; template lines are blanked out
+        - Manifest is the list of files to stage (default MOSS_FILES)
+        - Incremental skips student directories that are up to date
 
     Returns:
         - None
     '''
-    os.mkdir("Mossbox")
+    manifest = manifest or _FILES
+    match = manifest_matcher(manifest)
+    stamp = hashlib.sha256("\0".join(sorted(manifest) + [
+        subtractor.version if subtractor else ""]).encode()).hexdigest()
+
+    os.makedirs("Mossbox", exist_ok=True)
+    state_path = os.path.join("Mossbox", ".staged.json")
+    state = {}
+    if incremental and os.path.isfile(state_path):
+        with open(state_path) as f:
+            state = json.load(f)
+    index_path = os.path.join(GIT_CONFIG['index_dir'], f"files-{project}.json")
+    file_index = {}
+    if os.path.isfile(index_path):
+        with open(index_path) as f:
+            file_index = json.load(f)
+
+    start = time.time()
+    staged = unchanged = 0
     project_dir = "{}/{}".format(os.getcwd(), project)
     repos = os.listdir(project_dir)
     for repo in repos:
         repo_dir = "{}/{}".format(project_dir, repo)
-        print(repo_dir)
         if os.path.isdir(repo_dir):
             githubid = repo.replace(project+"-", "")
             studentdir = os.path.join(os.getcwd()+"/Mossbox/"+githubid)
+            head = git_quiet(["rev-parse", "HEAD"], repo_dir).stdout.strip() or None
+            if head and os.path.isdir(studentdir) and \
+                    state.get(githubid) == {'head': head, 'stamp': stamp}:
+                unchanged += 1
+                continue
+            shutil.rmtree(studentdir, ignore_errors=True)
             os.mkdir(studentdir)
-            for root, dir, files in os.walk(repo_dir):
-                for file in files:
-                    if file in _FILES:
-                        shutil.copy(os.path.join(root, file), studentdir)
-                        print(file)
+            for path in repo_files(repo_dir, head, file_index):
+                file = os.path.basename(path)
+                src = os.path.join(repo_dir, path)
+                # Sparse clones list files that are not checked out.
+                if not match(file) or not os.path.isfile(src):
+                    continue
+                if subtractor is None:
+                    link_or_copy(src, os.path.join(studentdir, file))
+                else:
+                    with open(src, errors="replace") as f:
+                        text = subtractor.subtract(file, f.read())
+                    with open(os.path.join(studentdir, file), "w") as f:
+                        f.write(text)
+            state[githubid] = {'head': head, 'stamp': stamp}
+            staged += 1
         else:
             print(f"\n{repo} is not a directory, and can't be a repo")
 
+    with open(state_path, "w") as f:
+        json.dump(state, f, indent=1)
+    os.makedirs(GIT_CONFIG['index_dir'], exist_ok=True)
+    with open(index_path, "w") as f:
+        json.dump(file_index, f)
+    print(f"Staged {staged} repos into Mossbox in {time.time() - start:.1f}s, "
+          f"{unchanged} unchanged")
+
+
+def make_subtractor():
+    '''
+    Sets up template subtraction against PARENT_REPO, whose mirror is
+    shared with clone --reference (see template_store).
+
+    Returns:
+        - TemplateSubtractor, or None if PARENT_REPO can't be fetched
+    '''
+    if _parent is None:
+        print("Set PARENT_REPO to subtract the template")
+        return None
+    store = template_store(_parent)
+    if store is None:
+        return None
+    return TemplateSubtractor(
+        store, os.path.join(GIT_CONFIG['index_dir'], "subtract"))
+
+
+def similarity_check(corpus_name, term=None, top=100):
+    '''
+    Runs the built-in similarity engine (winnowing fingerprints, see
+    similarity/winnow.py) over the submissions staged in Mossbox by moss.
+    Runs offline, in place of uploading Mossbox to the moss server.
+    Writes the ranked matches to similarity.txt and similarity.json.
+
+    The cohort is also checked against the cross-term corpus of the
+    assignment (see similarity/corpus.py), with matches written to
+    similarity_corpus.txt and similarity_corpus.json. With a term the
+    cohort is then archived into the corpus.
+
+    Parameters:
+        - Corpus_name names the corpus, in GIT_CONFIG['corpus_dir']
+        - Term labels the cohort when archiving it (e.g., 2024-fall)
+        - Top is the number of matches written to the text reports
+
+    Returns:
+        - None
+    '''
+    start = time.time()
+    docs = winnow.fingerprint_dir("Mossbox")
+    matches = winnow.compare(docs)
+    with open("similarity.txt", "w") as f:
+        winnow.write_report(matches, f, top)
+    with open("similarity.json", "w") as f:
+        json.dump(matches, f, indent=2)
+    print(f"Compared {len(docs)} submissions in {time.time() - start:.1f}s: "
+          f"{len(matches)} pairs above threshold, see similarity.txt")
+
+    start = time.time()
+    store = corpus.Corpus(os.path.join(GIT_CONFIG['corpus_dir'], corpus_name))
+    try:
+        matches = corpus.search(store, docs, exclude_term=term)
+        with open("similarity_corpus.txt", "w") as f:
+            winnow.write_report(matches, f, top)
+        with open("similarity_corpus.json", "w") as f:
+            json.dump(matches, f, indent=2)
+        print(f"Checked against corpus {corpus_name} in "
+              f"{time.time() - start:.1f}s: {len(matches)} matches with "
+              "past terms, see similarity_corpus.txt")
+        if term:
+            added = corpus.archive(store, docs, term)
+            print(f"Archived {added} new submissions as {term}")
+    finally:
+        store.close()
+
 
 def getmarks(json_dict):
     points = 0
@@ -356,70 +903,495 @@ def getmarks(json_dict):
             points += int(v['mark'])
     return points
 
-def compile_check(project):
+# Flags of every compile-check run; part of the diagnostics cache key.
+# The diagnostics flags pin clang's one-line-per-diagnostic output format.
+CLANG_FLAGS = ["-Wall", "-fsyntax-only", "-fno-color-diagnostics",
+               "-fno-caret-diagnostics", "-fdiagnostics-show-option",
+               "-I", "include/", "-I", "../include"]
+
+# file:line:col: severity: message [-Wflag,...]
+_CLANG_DIAGNOSTIC = re.compile(
+    r"^(?P<file>[^:\n]+):(?P<line>\d+):(?P<col>\d+): "
+    r"(?P<severity>fatal error|error|warning|note|remark): "
+    r"(?P<message>.*?)(?: \[(?P<flags>-W[^\]]*)\])?$")
+
+# Used when the COMPILE_RULES file does not exist.
+DEFAULT_COMPILE_RULES = [
+    {"name": "missing-return",
+     "message": "non-void function does not return a value",
+     "min_points": 0}
+]
+
+
+# Files in a source's own directory that an #include "..." may name.
+_HEADER_SUFFIXES = (".h", ".hh", ".hpp", ".hxx", ".inc", ".def")
+
+
+def include_digest(ppath, memo):
+    '''
+    Hashes the headers clang can see from a directory: those next to the
+    file (and below), which #include "..." finds first, and those in the
+    include directories of CLANG_FLAGS.
+
+    Parameters:
+        - Ppath is the directory clang runs in
+        - Memo is a dict caching digests per include directory
+
+    Returns:
+        - Hex digest of the names and contents of the headers
+    '''
+    digest = hashlib.sha256()
+    for inc in (".", "include", "../include"):
+        inc_dir = os.path.normpath(os.path.join(ppath, inc))
+        if (inc, inc_dir) not in memo:
+            h = hashlib.sha256()
+            for root, dirs, files in os.walk(inc_dir):
+                dirs.sort()
+                for file in sorted(files):
+                    if inc == "." and not file.endswith(_HEADER_SUFFIXES):
+                        continue
+                    path = os.path.join(root, file)
+                    h.update(os.path.relpath(path, inc_dir).encode() + b"\0")
+                    with open(path, "rb") as f:
+                        h.update(hashlib.sha256(f.read()).digest())
+            memo[(inc, inc_dir)] = h.hexdigest()
+        digest.update(memo[(inc, inc_dir)].encode())
+    return digest.hexdigest()
+
+
+def clang_diagnostics(ppath, file):
+    '''
+    Runs clang over one file. Only syntax and semantic checks are run and
+    no object file is written, so any number can run at once.
+
+    Parameters:
+        - Ppath is the directory the file is in (clang runs there)
+        - File is the file name
+
+    Returns:
+        - List of diagnostic dicts with file (relative to ppath), line, col,
+          severity, message and flags
+    '''
+    p = subprocess.run(["clang"] + CLANG_FLAGS + [file], cwd=ppath,
+                       capture_output=True)
+    records = []
+    for l in p.stderr.decode("utf-8", "replace").splitlines():
+        m = _CLANG_DIAGNOSTIC.match(l)
+        if m:
+            record = m.groupdict()
+            record['line'] = int(record['line'])
+            record['col'] = int(record['col'])
+            record['flags'] = record['flags'].split(",") if record['flags'] else []
+            records.append(record)
+    return records
+
+
+def load_compile_rules():
+    '''
+    Loads the compile-check rules from the JSON file named by
+    GIT_CONFIG['compile_rules'], falling back to DEFAULT_COMPILE_RULES.
+
+    Each rule has a name and any of the following criteria, all of which
+    a diagnostic must meet to be reported under that rule:
+        - flag: warning option, e.g. -Wreturn-type
+        - message: regular expression searched in the message
+        - severity: list of severities, e.g. ["error", "fatal error"]
+        - min_points / max_points: bounds on the repo's run-local score
+
+    Returns:
+        - List of rule dicts
+    '''
+    path = GIT_CONFIG['compile_rules']
+    if not os.path.isfile(path):
+        return DEFAULT_COMPILE_RULES
+    with open(path) as f:
+        return json.load(f)
+
+
+def match_rules(record, rules, points):
+    '''
+    Finds the rules a diagnostic falls under.
+
+    Parameters:
+        - Record is a diagnostic dict from clang_diagnostics
+        - Rules is the list from load_compile_rules
+        - Points is the repo's run-local score
+
+    Returns:
+        - List of names of the matching rules
+    '''
+    names = []
+    for rule in rules:
+        if 'flag' in rule and rule['flag'] not in record['flags']:
+            continue
+        if 'message' in rule and not re.search(rule['message'], record['message']):
+            continue
+        if 'severity' in rule and record['severity'] not in rule['severity']:
+            continue
+        if points < rule.get('min_points', float("-inf")):
+            continue
+        if points > rule.get('max_points', float("inf")):
+            continue
+        names.append(rule['name'])
+    return names
+
+
+def compile_check(project, subtractor=None):
     '''
     Obtain a file, and set it up in the appropriate student directory
 
+    Diagnostics are cached by the file contents plus the headers it can
+    include, so identical files (untouched template code, copied
+    submissions) are compiled once, and only the files that changed since
+    the last check are compiled again. Compiles run on
+    GIT_CONFIG['run_jobs'] workers.
+
+    Every diagnostic goes through all rules from load_compile_rules in one
+    pass. A file that could not be checked (e.g., clang is missing) is
+    reported under compile-check-failed and compiled again next time.
+    Findings are written to compile_check.txt (links per repo) and
+    compile_check.json. With a TemplateSubtractor, diagnostics on lines
+    that come unchanged from the template are dropped.
+
     Parameters:
         - Project which should match the name of the sub-directory containing
           the git repositories which should be added, committed and pushed to.
         - Comment parameter determines if the commit should be a comment or not
+        - Subtractor (a TemplateSubtractor) to ignore template code
 
     Returns:
         - None
     '''
     project_dir = "{}/{}".format(os.getcwd(), project)
+    cache_dir = os.path.join(GIT_CONFIG['index_dir'], "diagnostics")
+    pathlib.Path(cache_dir).mkdir(parents=True, exist_ok=True)
     repos = os.listdir(project_dir)
+
+    # Key every file first, so each distinct one is compiled only once.
+    memo = {}
+    sources = {}
+    todo = {}
+    for repo in repos:
+        repo_dir = "{}/{}".format(project_dir, repo)
+        if not os.path.isdir(repo_dir):
+            print(f"\n{repo} is not a directory, and can't be a repo")
+            continue
+        sources[repo] = []
+        for root, dir, files in os.walk(repo_dir):
+            for file in files:
+                if file in _FILES:
+                    ppath = os.path.join(root, "")
+                    key = hashlib.sha256(" ".join(CLANG_FLAGS).encode())
+                    with open(ppath + file, "rb") as f:
+                        key.update(hashlib.sha256(f.read()).digest())
+                    key.update(file.encode())
+                    key.update(include_digest(ppath, memo).encode())
+                    key = key.hexdigest()
+                    sources[repo].append((ppath, file, key))
+                    if not os.path.isfile(os.path.join(cache_dir, key)):
+                        todo.setdefault(key, (ppath, file))
+
+    n_files = sum(len(files) for files in sources.values())
+    print(f"{n_files} files, {len(todo)} to compile")
+
+    # Files that could not be checked get a single 'check-failed'
+    # diagnostic, which is reported but never cached.
+    failed = {}
+
+    def check_failed(file, reason):
+        return [{'file': file, 'line': 0, 'col': 0, 'severity': "check-failed",
+                 'message': reason, 'flags': []}]
+
+    if todo and shutil.which("clang") is None:
+        print(f"clang not found on PATH: {len(todo)} files could not be "
+              "checked (install clang; cached diagnostics are still reported)")
+        for key, (ppath, file) in todo.items():
+            failed[key] = check_failed(file, "clang not found")
+        todo = {}
+    with ThreadPoolExecutor(max_workers=GIT_CONFIG['run_jobs']) as pool:
+        futures = {pool.submit(clang_diagnostics, ppath, file): key
+                   for key, (ppath, file) in todo.items()}
+        for future in as_completed(futures):
+            key = futures[future]
+            try:
+                records = future.result()
+            except Exception as e:
+                failed[key] = check_failed(todo[key][1], f"compile-check failed: {e}")
+                continue
+            with open(os.path.join(cache_dir, key) + ".tmp", "w") as f:
+                json.dump(records, f)
+            os.replace(os.path.join(cache_dir, key) + ".tmp",
+                       os.path.join(cache_dir, key))
+    if failed:
+        print(f"{len(failed)} files could not be checked, see compile_check.txt")
+
+    rules = load_compile_rules()
+    report = {}
     check_file = open("compile_check.txt", "w")
     for repo in repos:
+        if repo not in sources:
+            continue
         repo_dir = "{}/{}".format(project_dir, repo)
-        print(repo_dir)
-        if os.path.isdir(repo_dir):
-            githubid = repo.replace(project+"-", "")
-            #studentdir = os.path.join(os.getcwd()+"/Mossbox/"+githubid)
-            # os.mkdir(studentdir)
-            points = 0
-            ASS = "{}/{}".format(os.getcwd(), "ASS1")
-            if os.path.exists(ASS+f"/FAIL/{repo}_Grade.json"):
-                f = open(ASS+f"/FAIL/{repo}_Grade.json")
-                points = getmarks(json.load(f))
-            if os.path.exists("ASS1/PASS/"+repo+"_Grade.json"):
-                f = open(ASS+f"/PASS/{repo}_Grade.json")
-                points = getmarks(json.load(f))
-            for root, dir, files in os.walk(repo_dir):
-                Errors = ""
-                for file in files:
-                    if file in _FILES:
-                        ppath = os.path.join(root,"")
-                        p = subprocess.Popen(f"clang -Wall -c -I include/ -I ../include -o /tmp/1.o {file}", shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=ppath)
-                        out, err = p.communicate()
-                        lines = err.decode("utf-8")
-                        list = lines.split("\n")
-                        for l in list:
-                            # Check their score. If score greater than x then validate.
-                            if "non-void function does not return a value" in l:
-                                if points >= 0:
-                                    links = l.split(":")
-                                    relpath = os.path.relpath(ppath+file, repo_dir)
-                                    url = f"https://github.com/CMPT-295-SFU/{repo}/blob/master/{relpath}?plain=1#L{links[1]}"
-                                    #Errors += f"\n{repo}:{l}"
-                                    Errors += f"\n{url}"
-                        #shutil.copy(os.path.join(root, file), studentdir)
-  #                              print(file)
-                if Errors != "":
-                    print(f"\n############### {repo} {points} ###############", file=check_file)
-                    print(Errors, file = check_file)
-                    print("\n############### END ###############", file = check_file)
+        githubid = repo.replace(project+"-", "")
+        points = 0
+        ASS = "{}/{}".format(os.getcwd(), "ASS1")
+        if os.path.exists(ASS+f"/FAIL/{repo}_Grade.json"):
+            f = open(ASS+f"/FAIL/{repo}_Grade.json")
+            points = getmarks(json.load(f))
+        if os.path.exists("ASS1/PASS/"+repo+"_Grade.json"):
+            f = open(ASS+f"/PASS/{repo}_Grade.json")
+            points = getmarks(json.load(f))
+        Errors = ""
+        findings = []
+        template_lines = {}
+        for ppath, file, key in sources[repo]:
+            if key in failed:
+                records = failed[key]
+            else:
+                with open(os.path.join(cache_dir, key)) as f:
+                    records = json.load(f)
+            for record in records:
+                if record['severity'] == "check-failed":
+                    matched = ["compile-check-failed"]
+                else:
+                    matched = match_rules(record, rules, points)
+                if subtractor is not None and matched and record['line']:
+                    path = os.path.normpath(os.path.join(ppath, record['file']))
+                    if path not in template_lines:
+                        template_lines[path] = set()
+                        if os.path.isfile(path):
+                            with open(path, errors="replace") as f:
+                                template_lines[path] = subtractor.template_lines(
+                                    os.path.basename(path), f.read())
+                    if record['line'] in template_lines[path]:
+                        continue
+                for rule in matched:
+                    relpath = os.path.relpath(
+                        os.path.join(ppath, record['file']), repo_dir)
+                    url = f"https://github.com/CMPT-295-SFU/{repo}/blob/master/{relpath}?plain=1#L{record['line']}"
+                    Errors += f"\n{url} [{rule}]"
+                    findings.append(dict(record, file=relpath, rule=rule, url=url))
+        report[repo] = {'githubid': githubid, 'points': points,
+                        'findings': findings}
+        if Errors != "":
+            print(f"\n############### {repo} {points} ###############", file=check_file)
+            print(Errors, file = check_file)
+            print("\n############### END ###############", file = check_file)
+    check_file.close()
+    with open("compile_check.json", "w") as f:
+        json.dump(report, f, indent=2)
+
+
+def tail(path, lines):
+    '''
+    Reads the last lines of a file without loading all of it.
+
+    Parameters:
+        - Path of the file
+        - Lines is the number of lines wanted
+
+    Returns:
+        - String with (at most) the last lines of the file
+    '''
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        f.seek(max(0, f.tell() - 200 * lines))
+        data = f.read().decode("utf-8", "replace")
+    return "\n".join(data.splitlines()[-lines:])
+
+
+def store_log(src, dst, trailer=""):
+    '''
+    Files a run-local log gzip-compressed, keeping only its first
+    GIT_CONFIG['log_head'] KB and last GIT_CONFIG['log_tail'] KB, with a
+    marker saying how much was cut in between. A runaway test printing in
+    a loop then costs at most head + tail, both on disk and for every tool
+    that reads the log later.
+
+    Parameters:
+        - Src is the log written by the CI script
+        - Dst is the .log.gz to write
+        - Trailer is text appended to the log, e.g. a timeout note
+
+    Returns:
+        - Number of bytes cut from the middle of the log
+    '''
+    head_size = GIT_CONFIG['log_head'] * 1024
+    tail_size = GIT_CONFIG['log_tail'] * 1024
+    cut = 0
+    with open(src, "rb") as f, gzip.open(dst, "wb") as out:
+        size = os.fstat(f.fileno()).st_size
+        if size <= head_size + tail_size:
+            shutil.copyfileobj(f, out)
         else:
-            print(f"\n{repo} is not a directory, and can't be a repo")
+            out.write(f.read(head_size))
+            f.seek(size - tail_size)
+            tail = f.read()
+            # Resume the tail at a line boundary.
+            tail = tail[tail.find(b"\n") + 1:]
+            cut = size - head_size - len(tail)
+            out.write(f"\n... [{cut} bytes truncated] ...\n".encode())
+            out.write(tail)
+        out.write(trailer.encode())
+    return cut
+
+
+def run_localci(repo_dir, pass_dir, fail_dir):
+    '''
+    Runs scripts/localci.sh of one repo in a sandbox and files its log.
+
+    The script runs in its own session with a scratch TMPDIR, under ulimit
+    CPU time, address space, process and file size limits, and is killed
+    (with every process it started) after GIT_CONFIG['run_timeout'] seconds.
+    Its log (bounded and compressed by store_log) and _Grade.json are filed
+    in pass_dir or fail_dir depending on the SUCCESS/FAILED marker it leaves.
+    The outputs of a previous run are deleted first, since the clone is
+    updated in place, so a script that writes nothing is an 'error'. A timed
+    out run is filed in fail_dir with its captured output.
 
+    Parameters:
+        - Repo_dir is the directory path of the repo
+        - Pass_dir and fail_dir are the ASS_ROOT/PASS and ASS_ROOT/FAIL dirs
 
+    Returns:
+        - Tuple of (status, detail) where status is one of
+          'pass', 'fail', 'timeout' or 'error'
+    '''
+    name = os.path.basename(repo_dir)
+    limits = []
+    if GIT_CONFIG['run_cpu_limit']:
+        limits.append(f"ulimit -t {GIT_CONFIG['run_cpu_limit']}")
+    if GIT_CONFIG['run_mem_limit']:
+        limits.append(f"ulimit -v {GIT_CONFIG['run_mem_limit'] * 1024}")
+    if GIT_CONFIG['run_nproc_limit']:
+        limits.append(f"ulimit -u {GIT_CONFIG['run_nproc_limit']}")
+    if GIT_CONFIG['run_file_limit']:
+        limits.append(f"ulimit -f {GIT_CONFIG['run_file_limit'] * 1024}")
+    script = " && ".join(limits + ['exec bash "$0"'])
+
+    for stale in ("SUCCESS", "FAILED", name + ".log.success", name + ".log.failed",
+                  name + "_Grade.json"):
+        if os.path.isfile(os.path.join(repo_dir, stale)):
+            os.remove(os.path.join(repo_dir, stale))
+
+    scratch = tempfile.mkdtemp(prefix=f"{name}-")
+    env = dict(os.environ, TMPDIR=scratch, TMP=scratch, TEMP=scratch)
+    output = os.path.join(scratch, "output")
+    try:
+        with open(output, "wb") as out:
+            p = subprocess.Popen(
+                ["bash", "-c", script, repo_dir + "/scripts/localci.sh"],
+                cwd=repo_dir, env=env, stdin=subprocess.DEVNULL,
+                stdout=out, stderr=subprocess.STDOUT, start_new_session=True)
+            try:
+                p.wait(timeout=GIT_CONFIG['run_timeout'])
+            except subprocess.TimeoutExpired:
+                os.killpg(p.pid, signal.SIGKILL)
+                p.wait()
+                store_log(output, fail_dir + "/" + name + ".log.gz",
+                          f"\nResult: TIMEOUT after {GIT_CONFIG['run_timeout']}s\n")
+                return "timeout", f"killed after {GIT_CONFIG['run_timeout']}s"
+
+        # Check for success of failure
+        for marker, suffix, dest, status in (("FAILED", ".log.failed", fail_dir, "fail"),
+                                             ("SUCCESS", ".log.success", pass_dir, "pass")):
+            if not os.path.isfile(repo_dir + "/" + marker):
+                continue
+            log = repo_dir + "/" + name + suffix
+            grade = repo_dir + "/" + name + "_Grade.json"
+            if not os.path.isfile(log) or not os.path.isfile(grade):
+                return "error", f"{marker} written without {os.path.basename(log)} " \
+                    f"and {os.path.basename(grade)}: {tail(output, 1)}"
+            store_log(log, dest + "/" + name + ".log.gz")
+            shutil.copy(grade, dest + "/" + name + "_Grade.json")
+            return status, ""
+        return "error", f"exit {p.returncode}, no SUCCESS/FAILED: {tail(output, 1)}"
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def result_cache_key(repo_dir):
+    '''
+    Computes the key under which a run-local result is cached: the repo's
+    HEAD commit plus a hash of the grading harness in scripts/, which may
+    carry local edits that are not committed, and of the sandbox limits,
+    since a run under other limits may end differently.
+
+    Parameters:
+        - Repo_dir is the directory path of the repo
+
+    Returns:
+        - Hex digest, or None if the repo has no HEAD commit
+    '''
+    p = git_quiet(["rev-parse", "HEAD"], repo_dir)
+    if p.returncode != 0:
+        return None
+    key = hashlib.sha256(p.stdout.strip().encode())
+    key.update(json.dumps([GIT_CONFIG[k] for k in (
+        'run_timeout', 'run_cpu_limit', 'run_mem_limit', 'run_nproc_limit',
+        'run_file_limit')]).encode())
+    scripts = os.path.join(repo_dir, "scripts")
+    for root, dirs, files in os.walk(scripts):
+        dirs.sort()
+        for file in sorted(files):
+            path = os.path.join(root, file)
+            key.update(os.path.relpath(path, scripts).encode() + b"\0")
+            with open(path, "rb") as f:
+                key.update(hashlib.sha256(f.read()).digest())
+    return key.hexdigest()
+
+
+def run_cached(repo_dir, pass_dir, fail_dir, cache_dir):
+    '''
+    Files a repo's run-local result from the cache if its key is unchanged,
+    otherwise runs it with run_localci and caches what it filed.
+    Runs that ended in 'error' or 'timeout' are not cached: both may be
+    caused by the machine (e.g., load) rather than the submission.
+
+    Parameters:
+        - Repo_dir is the directory path of the repo
+        - Pass_dir and fail_dir are the ASS_ROOT/PASS and ASS_ROOT/FAIL dirs
+        - Cache_dir holds one entry per repo of the project
+
+    Returns:
+        - Tuple of (status, detail); detail is 'cached' for a cache hit
+    '''
+    name = os.path.basename(repo_dir)
+    entry = os.path.join(cache_dir, name)
+    meta_path = os.path.join(entry, "meta.json")
+    key = result_cache_key(repo_dir)
+    if key is not None and GIT_CONFIG['run_cache'] and os.path.isfile(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta['key'] == key and meta.get('logs') == "gzip":
+            dest = pass_dir if meta['status'] == "pass" else fail_dir
+            for file in meta['files']:
+                shutil.copy(os.path.join(entry, file), dest)
+            return meta['status'], "cached"
+
+    status, detail = run_localci(repo_dir, pass_dir, fail_dir)
+    if key is not None and status not in ("error", "timeout"):
+        dest = pass_dir if status == "pass" else fail_dir
+        files = [file for file in (name + ".log.gz", name + "_Grade.json")
+                 if os.path.isfile(os.path.join(dest, file))]
+        shutil.rmtree(entry, ignore_errors=True)
+        os.makedirs(entry)
+        for file in files:
+            shutil.copy(os.path.join(dest, file), entry)
+        with open(meta_path, "w") as f:
+            json.dump({'key': key, 'status': status, 'files': files,
+                       'logs': "gzip"}, f)
+    return status, detail
 
 
 def run(project):
     '''
     Obtain a file, and set it up in the appropriate student directory.
     Run project.
+    Repos are run by a pool of GIT_CONFIG['run_jobs'] workers, each
+    sandboxed by run_localci. ASS_ROOT is rebuilt on every run, but repos
+    whose HEAD and harness are unchanged since their last run are filed from
+    the result cache instead of being run again (see run_cached).
     Parameters:
         - Project which should match the name of the sub-directory containing
           the git repositories which should be added, committed and pushed to.
@@ -437,31 +1409,181 @@ def run(project):
     FAIL_DIR = "{}/{}".format(os.getcwd(), "ASS_ROOT/FAIL")
 
     project_dir = "{}/{}".format(os.getcwd(), project)
+    cache_dir = os.path.join(GIT_CONFIG['index_dir'], "results", project)
     repos = os.listdir(project_dir)
-    for repo in repos:
-        repo_dir = "{}/{}".format(project_dir, repo)
-#        print(repo_dir)
-        if os.path.isdir(repo_dir):
-            if (os.path.isfile(repo_dir + "/scripts/localci.sh")):
-                subprocess.run(
-                    ["bash", repo_dir + "/scripts/localci.sh"], cwd=repo_dir)
-                # Check for success of failure
-                if (os.path.isfile(repo_dir+"/FAILED")):
-                    shutil.copy(repo_dir+"/"+os.path.basename(repo_dir) +
-                                ".log.failed", FAIL_DIR + "/" + os.path.basename(repo_dir) + ".log")
-                    shutil.copy(repo_dir+"/"+os.path.basename(repo_dir) +
-                                "_Grade.json", FAIL_DIR+"/"+os.path.basename(repo_dir) +
-                                "_Grade.json")
-                if (os.path.isfile(repo_dir+"/SUCCESS")):
-                    shutil.copy(repo_dir+"/"+os.path.basename(repo_dir) +
-                                ".log.success", PASS_DIR + "/" + os.path.basename(repo_dir) + ".log")
-                    shutil.copy(repo_dir+"/"+os.path.basename(repo_dir) +
-                                "_Grade.json", PASS_DIR+"/"+os.path.basename(repo_dir) +
-                                "_Grade.json")
+    results = {}
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=GIT_CONFIG['run_jobs']) as pool:
+        futures = {}
+        for repo in repos:
+            repo_dir = "{}/{}".format(project_dir, repo)
+            if os.path.isdir(repo_dir):
+                if (os.path.isfile(repo_dir + "/scripts/localci.sh")):
+                    futures[pool.submit(run_cached, repo_dir,
+                                        PASS_DIR, FAIL_DIR, cache_dir)] = repo
+                else:
+                    print(f"localci.sh does not exist in {repo}")
             else:
-                print("localci.sh does not exist in repo")
-        else:
-            print(f"\n{repo} is not a directory, and can't be a repo")
+                print(f"\n{repo} is not a directory, and can't be a repo")
+        for n, future in enumerate(as_completed(futures), 1):
+            repo = futures[future]
+            try:
+                results[repo] = future.result()
+            except Exception as e:
+                results[repo] = ("error", str(e))
+            print(f"[{n}/{len(futures)}] {repo}: {' '.join(results[repo])}".rstrip())
+
+    print_summary(results, problems=("timeout", "error"))
+    cached = sum(1 for _, detail in results.values() if detail == "cached")
+    print(f"Ran {len(results) - cached} repos ({cached} from cache) "
+          f"in {time.time() - start:.0f}s")
+    build_log_index("./ASS_ROOT")
+
+
+_LOG_WORD = re.compile(r"\w+")
+
+
+def log_files(root):
+    '''
+    Lists the compressed logs filed by run-local under root, as paths
+    relative to it (e.g., FAIL/assignment-1-alice.log.gz).
+    '''
+    logs = []
+    for kind in ("PASS", "FAIL"):
+        if os.path.isdir(os.path.join(root, kind)):
+            logs += sorted(os.path.join(kind, file)
+                           for file in os.listdir(os.path.join(root, kind))
+                           if file.endswith(".log.gz"))
+    return logs
+
+
+def build_log_index(root):
+    '''
+    Builds the search index of the logs under root and saves it as
+    <root>/logs.idx.gz: the lowercased words of every log, each with the
+    logs it occurs in. The index is rebuilt only when logs were added,
+    removed or rewritten since it was saved.
+
+    Parameters:
+        - Root is the ASS_ROOT directory
+
+    Returns:
+        - Dict with 'logs' (path -> mtime) and 'words' (word -> log numbers,
+          in the order of 'logs')
+    '''
+    logs = {log: os.stat(os.path.join(root, log)).st_mtime_ns
+            for log in log_files(root)}
+    path = os.path.join(root, "logs.idx.gz")
+    if os.path.isfile(path):
+        with gzip.open(path, "rt") as f:
+            index = json.load(f)
+        if index['logs'] == logs:
+            return index
+
+    words = {}
+    for n, log in enumerate(logs):
+        with gzip.open(os.path.join(root, log), "rt", errors="replace") as f:
+            for word in set(_LOG_WORD.findall(f.read().lower())):
+                words.setdefault(word, []).append(n)
+    index = {'logs': logs, 'words': words}
+    with gzip.open(path + ".tmp", "wt") as f:
+        json.dump(index, f)
+    os.replace(path + ".tmp", path)
+    return index
+
+
+def required_literals(pattern):
+    '''
+    Finds strings that every match of a regular expression must contain,
+    to narrow a search down with the log index. Conservative: alternations
+    give nothing, and groups, classes, escapes and optional characters
+    break the literal runs.
+
+    Parameters:
+        - Pattern is the regular expression
+
+    Returns:
+        - List of literal strings
+    '''
+    if "|" in pattern:
+        return []
+    literals = []
+    run = ""
+    depth = 0
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == "\\" and i + 1 < len(pattern):
+            nxt = pattern[i + 1]
+            if nxt.isalnum():
+                literals.append(run)
+                run = ""
+            elif depth == 0:
+                run += nxt
+            i += 2
+            continue
+        if c in "?*{":
+            # The previous character may not be there at all.
+            literals.append(run[:-1])
+            run = ""
+            if c == "{":
+                i = pattern.find("}", i) % (len(pattern) + 1)
+        elif c == "[":
+            literals.append(run)
+            run = ""
+            i = pattern.find("]", i + 2) % (len(pattern) + 1)
+        elif c in ".^$+":
+            literals.append(run)
+            run = ""
+        elif c == "(":
+            literals.append(run)
+            run = ""
+            depth += 1
+        elif c == ")":
+            depth = max(0, depth - 1)
+        elif depth == 0:
+            run += c
+        i += 1
+    literals.append(run)
+    return [literal for literal in literals if literal]
+
+
+def grep_logs(pattern, root="ASS_ROOT"):
+    '''
+    Searches every run-local log for a regular expression. The log index
+    (see build_log_index) narrows the search to logs that contain all the
+    words of the pattern's literal parts; only those are decompressed.
+
+    Parameters:
+        - Pattern is the regular expression
+        - Root is the ASS_ROOT directory
+
+    Returns:
+        - None
+    '''
+    start = time.time()
+    regex = re.compile(pattern)
+    index = build_log_index(root)
+    logs = list(index['logs'])
+    candidates = set(range(len(logs)))
+    for literal in required_literals(pattern):
+        for word in _LOG_WORD.findall(literal.lower()):
+            # A word of the pattern may be part of a longer word in a log.
+            found = set()
+            for indexed, postings in index['words'].items():
+                if word in indexed:
+                    found.update(postings)
+            candidates &= found
+
+    hits = 0
+    for n in sorted(candidates):
+        with gzip.open(os.path.join(root, logs[n]), "rt", errors="replace") as f:
+            for lineno, line in enumerate(f, 1):
+                if regex.search(line):
+                    print(f"{logs[n]}:{lineno}: {line.rstrip()}")
+                    hits += 1
+    print(f"{hits} matching lines; searched {len(candidates)} of {len(logs)} "
+          f"logs in {time.time() - start:.2f}s")
 
 
 def add_commit_push_all(project):
@@ -481,15 +1603,19 @@ def add_commit_push_all(project):
 
     project_dir = "{}/{}".format(os.getcwd(), project)
     repos = os.listdir(project_dir)
+    tasks = {}
+    digests = {}
     for repo in repos:
         repo_dir = "{}/{}".format(project_dir, repo)
         if os.path.isdir(repo_dir):
-            git_add_commit_push(
-                "*", repo_dir, 'Added everything. Typically after a local run.')
-            print("Pushed changes to github")
+            tasks[repo] = functools.partial(
+                git_add_commit_push, "*", repo_dir, 'Added everything. Typically after a local run.')
+            digests[repo] = worktree_digest(repo_dir)
         else:
             print(f"\n{repo} is not a directory, and can't be a repo")
 
+    push_pipeline(f"add-commit-{project}", tasks, digests)
+
 
 def pull_template_commit(project, parent, istemplate):
     '''
@@ -507,19 +1633,30 @@ def pull_template_commit(project, parent, istemplate):
         - None
     '''
 
+    # Fetch the parent once; every repo then pulls from the local store.
+    store = template_store(parent)
+    # A new template commit makes every repo due again.
+    head = git_quiet(["rev-parse", "HEAD"], store).stdout.strip() if store else None
+    parent = store or parent
     project_dir = "{}/{}".format(os.getcwd(), project)
     repos = os.listdir(project_dir)
+    tasks = {}
     for repo in repos:
         repo_dir = "{}/{}".format(project_dir, repo)
         if os.path.isdir(repo_dir):
             if (istemplate):
-                git_pull_template_commit(parent, repo_dir)
+                tasks[repo] = functools.partial(
+                    git_pull_template_commit, parent, repo_dir)
             else:
-                git_pull_fork_commit(parent, repo_dir)
-            print("Pushed changes to github")
+                tasks[repo] = functools.partial(
+                    git_pull_fork_commit, parent, repo_dir)
         else:
             print(f"\n{repo} is not a directory, and can't be a repo")
 
+    kind = "template" if istemplate else "fork"
+    push_pipeline(f"update-from-{kind}-{project}", tasks,
+                  dict.fromkeys(tasks, head))
+
 
 def list_matching(project, organization):
     '''
@@ -532,221 +1669,839 @@ def list_matching(project, organization):
     Returns:
         - None
     '''
-    g = Github(GIT_CONFIG['key'])
-    for repo in g.get_user().get_repos():
-        if is_matching(repo, project, organization):
-            print(repo.name)
+    g = ghclient.github(GIT_CONFIG['key'])
+    for repo in matching_repos(g, project, organization):
+        print(repo.name)
 
 
-def set_matching_readonly(project, organization, push_or_pull):
+def permission_level(collab):
+    '''
+    Reads a collaborator's current permission on a repo, as listed by
+    repo.get_collaborators().
+
+    Returns:
+        - One of 'admin', 'maintain', 'push', 'triage', 'pull', or None
+          if the listing did not say
     '''
-    Sets the matching repositories to read-only for all non-owners.
-    Can be used to revoke students' write permissions.
+    p = getattr(collab, "permissions", None)
+    if p is None:
+        return None
+    for level in ("admin", "maintain", "push", "triage", "pull"):
+        if getattr(p, level, False):
+            return level
+    return None
 
-    PS: Will ONLY work if the github library is modified.
-        See github.com/NikolaiMagnussen/pygithub.
+
+def needs_change(level, push_or_pull):
+    '''
+    Whether a collaborator at the given level has to be changed to reach
+    push_or_pull ('push', 'pull' or 'remove'). Unknown levels are changed.
+    '''
+    if level is None or push_or_pull == "remove":
+        return True
+    if push_or_pull == "pull":
+        return level in ("admin", "maintain", "push")
+    return level not in ("admin", "maintain", "push")
+
+
+def collaborator_changes(repo, push_or_pull):
+    '''
+    Lists the collaborators of a repo whose permission differs from
+    push_or_pull, leaving out the owners.
+
+    Returns:
+        - Tuple of (list of collaborators to change, number already right)
+    '''
+    changes = []
+    unchanged = 0
+    for collab in repo.get_collaborators():
+        if collab.login in GIT_CONFIG['owners']:
+            continue
+        if needs_change(permission_level(collab), push_or_pull):
+            changes.append(collab)
+        else:
+            unchanged += 1
+    return changes, unchanged
+
+
+def apply_permission(writes, repo, collab, push_or_pull):
+    '''
+    Sets one collaborator's permission, or removes them, through the write
+    scheduler (see ghclient.WriteScheduler).
+
+    Returns:
+        - Tuple of (status, detail) where status is 'changed' or 'failed'
+    '''
+    try:
+        if push_or_pull == "remove":
+            writes.call(repo.remove_from_collaborators, collab)
+        else:
+            writes.call(repo.add_to_collaborators, collab, push_or_pull)
+        return "changed", ""
+    except (ghclient.RateLimited, requests.RequestException) as e:
+        return "failed", str(e)
+    except GithubException as e:
+        detail = str(e)
+        if push_or_pull == "pull":
+            detail += " (readonly is only possible in orgs)"
+        return "failed", detail
+
+
+def change_permissions(project, organization, push_or_pull):
+    '''
+    Sets every non-owner collaborator of the matching repositories to
+    push_or_pull, or removes them.
+
+    The collaborator lists of all repos are fetched concurrently, each
+    with its members' current permission, and only collaborators whose
+    permission differs are changed, concurrently, at the pace GitHub's rate
+    limits allow (see ghclient.WriteScheduler).
 
     Parameters:
         - Project name to be queried (repo name should contain this)
         - Organization name which should own the repo (if any)
+        - Push_or_pull is 'push', 'pull' or 'remove'
 
     Returns:
         - None
     '''
-    g = Github(GIT_CONFIG['key'])
-    for repo in g.get_user().get_repos():
-        if is_matching(repo, project, organization):
-            print("Changing permissions for {}".format(repo.name))
-            for collab in repo.get_collaborators():
-                if collab.login not in GIT_CONFIG['owners']:
-                    # Student found. change permissions from push to pull
-                    # repo.remove_from_collaborators(collab)
-                    try:
-                        repo.add_to_collaborators(collab, push_or_pull)
-                        print(f"{format(collab.login)} can only {push_or_pull}")
-                    except GithubException as e:
-                        print(e)
-                        repo.add_to_collaborators(collab)
-                        print("    {} can still write because readonly is only"
-                              " possible in orgs".format(collab.login))
-                else:
-                    print("    Owner: {}".format(collab.login))
+    start = time.time()
+    g = ghclient.github(GIT_CONFIG['key'])
+    repos = matching_repos(g, project, organization)
+    results = {}
+    changes = []
+    unchanged = 0
+    with ThreadPoolExecutor(max_workers=GIT_CONFIG['api_jobs']) as pool:
+        futures = {pool.submit(collaborator_changes, repo, push_or_pull): repo
+                   for repo in repos}
+        for future in as_completed(futures):
+            repo = futures[future]
+            try:
+                collabs, same = future.result()
+            except (GithubException, requests.RequestException) as e:
+                results[repo.name] = ("failed", str(e))
+                continue
+            unchanged += same
+            changes += [(repo, collab) for collab in collabs]
+        listed = time.time() - start
+
+    with ghclient.WriteScheduler(len(changes), "permission changes", g) as writes, \
+            ThreadPoolExecutor(max_workers=writes.limit) as pool:
+        futures = {pool.submit(apply_permission, writes, repo, collab, push_or_pull):
+                   f"{repo.name}/{collab.login}" for repo, collab in changes}
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+
+    print_summary(results)
+    print(f"{len(changes)} of {len(changes) + unchanged} collaborators across "
+          f"{len(repos)} repos needed a change to {push_or_pull}; "
+          f"listed in {listed:.1f}s, done in {time.time() - start:.1f}s")
 
 
-def set_matching_remove(project, organization, push_or_pull):
+def set_matching_readonly(project, organization, push_or_pull):
+    '''
+    Sets the matching repositories to read-only (or back to write) for all
+    non-owners. Can be used to revoke students' write permissions.
+    See change_permissions.
+
+    Parameters:
+        - Project name to be queried (repo name should contain this)
+        - Organization name which should own the repo (if any)
+        - Push_or_pull is 'pull' for read-only, 'push' for write
+
+    Returns:
+        - None
     '''
-    Sets the matching repositories to read-only for all non-owners.
-    Can be used to revoke students' write permissions.
+    change_permissions(project, organization, push_or_pull)
 
-    PS: Will ONLY work if the github library is modified.
-        See github.com/NikolaiMagnussen/pygithub.
+
+def set_matching_remove(project, organization, push_or_pull):
+    '''
+    Removes all non-owners from the matching repositories.
+    See change_permissions.
 
     Parameters:
         - Project name to be queried (repo name should contain this)
         - Organization name which should own the repo (if any)
+        - Push_or_pull is 'remove'
 
     Returns:
         - None
     '''
-    g = Github(GIT_CONFIG['key'])
-    for repo in g.get_user().get_repos():
-        if is_matching(repo, project, organization):
-            print("Changing permissions for {}".format(repo.name))
-            for collab in repo.get_collaborators():
-                if collab.login not in GIT_CONFIG['owners']:
-                    # Student found. change permissions from push to pull
-                    try:
-                        repo.remove_from_collaborators(collab)
-                        print(f"{format(collab.login)} can no longer access")
-                    except GithubException as e:
-                        print(e)
-                        repo.add_to_collaborators(collab)
-                        print("    {} can still write because readonly is only"
-                              " possible in orgs".format(collab.login))
-                else:
-                    print("    Owner: {}".format(collab.login))
+    change_permissions(project, organization, push_or_pull)
 
 
-def clone_matching(project, organization):
+def git_quiet(args, cwd):
+    '''
+    Runs a git command without a terminal prompt, capturing its output.
+
+    Parameters:
+        - Args is the list of arguments passed to git
+        - Cwd is the directory the command runs in
+
+    Returns:
+        - CompletedProcess with text stdout/stderr
+    '''
+    env = dict(os.environ, GIT_TERMINAL_PROMPT="0")
+    return subprocess.run(["git"] + args, cwd=cwd, env=env,
+                          capture_output=True, text=True)
+
+
+def read_manifest(name):
+    '''
+    Reads an assignment file manifest such as MOSS_FILES/ASS3.moss.
+    Manifests list file names separated by commas and/or whitespace.
+
+    Parameters:
+        - Name is either a path to a manifest or an assignment name
+          (e.g., ASS3) resolved to MOSS_FILES/<name>.moss
+
+    Returns:
+        - List of file names
+    '''
+    path = name if os.path.isfile(name) else f"MOSS_FILES/{name}.moss"
+    with open(path) as f:
+        return [x for x in re.split(r"[,\s]+", f.read()) if x]
+
+
+def template_store(parent):
+    '''
+    Mirrors the starter/template repo into a shared local object store
+    under GIT_CONFIG['index_dir'], or brings an existing mirror up to date.
+    Student clones borrow objects from it (git alternates), and
+    update-from-template/update-from-fork pull from it instead of fetching
+    the parent once per repo.
+
+    Parameters:
+        - Parent is the url of the template (PARENT_REPO)
+
+    Returns:
+        - Absolute path of the bare store, or None if it could not be fetched
+    '''
+    store = os.path.abspath(os.path.join(
+        GIT_CONFIG['index_dir'], "templates",
+        re.sub(r"[^A-Za-z0-9._-]", "_", parent) + ".git"))
+    if os.path.isdir(store):
+        p = git_quiet(["remote", "update", "--prune"], store)
+    else:
+        pathlib.Path(store).parent.mkdir(parents=True, exist_ok=True)
+        p = git_quiet(["clone", "--mirror", parent, store], os.getcwd())
+    if p.returncode != 0:
+        print(f"Could not fetch template {parent}: {p.stderr.strip()}")
+        return None
+    return store
+
+
+def clone_or_update(repo_url, project_dir, name, sparse=None, reference=None):
+    '''
+    Shallow clones a repo, or fast-forwards an existing clone.
+    A fetch inside a shallow clone only transfers commits newer than the
+    local ones, so an update after a late-submission window is cheap.
+
+    With a sparse file list the clone is blob-less (--filter=blob:none) and
+    only checks out files with those names, at any depth, plus headers so
+    compile-check still finds include/. Blobs of everything else are never
+    downloaded.
+
+    With a reference store (see template_store) the clone borrows objects
+    from it, and objects it already holds are dropped from the clone's own
+    pack, so each clone only stores what the student changed.
+
+    Parameters:
+        - Repo_url is the authenticated clone url
+        - Project_dir is the directory holding all clones of the project
+        - Name is the repository name (and clone directory)
+        - Sparse is an optional list of file names to check out
+        - Reference is an optional path to a shared object store
+
+    Returns:
+        - Tuple of (status, detail) where status is one of
+          'cloned', 'updated', 'up-to-date' or 'failed'
+    '''
+    repo_dir = os.path.join(project_dir, name)
+    if not os.path.isdir(os.path.join(repo_dir, ".git")):
+        clone = ["clone", "--depth", "1"]
+        if reference is not None:
+            clone += ["--reference", reference]
+        if sparse is None:
+            p = git_quiet(clone + [repo_url, name], project_dir)
+            steps = []
+        else:
+            p = git_quiet(clone + ["--filter=blob:none", "--no-checkout",
+                                   repo_url, name], project_dir)
+            steps = [["sparse-checkout", "set", "--no-cone", "*.h"] + sparse,
+                     ["checkout"]]
+        if reference is not None:
+            steps.append(["repack", "-a", "-d", "-l", "-q"])
+        for args in steps:
+            if p.returncode != 0:
+                return "failed", p.stderr.strip()
+            p = git_quiet(args, repo_dir)
+        if p.returncode != 0:
+            return "failed", p.stderr.strip()
+        return "cloned", "sparse" if sparse is not None else ""
+
+    if sparse is not None:
+        # The manifest may differ from the one the repo was cloned with.
+        p = git_quiet(["sparse-checkout", "set", "--no-cone", "*.h"] + sparse,
+                      repo_dir)
+        if p.returncode != 0:
+            return "failed", p.stderr.strip()
+
+    before = git_quiet(["rev-parse", "HEAD"], repo_dir).stdout.strip()
+    p = git_quiet(["fetch", "origin"], repo_dir)
+    if p.returncode != 0:
+        return "failed", p.stderr.strip()
+    p = git_quiet(["merge", "--ff-only", "@{u}"], repo_dir)
+    if p.returncode != 0:
+        return "failed", p.stderr.strip()
+    after = git_quiet(["rev-parse", "HEAD"], repo_dir).stdout.strip()
+    if before == after:
+        return "up-to-date", ""
+    return "updated", f"{before[:7]}..{after[:7]}"
+
+
+def clone_matching(project, organization, sparse=None, reference=False):
     '''
     Clone the matching repositories to a project directory.
+    Clones run in a pool of GIT_CONFIG['clone_jobs'] workers since they are
+    bound by network round trips. Repos that were cloned before are fetched
+    and fast-forwarded instead.
 
     Parameters:
         - Project name to be queried (repo name should contain this)
         - Organization name which should own the repo (if any)
+        - Sparse is an optional list of file names; see clone_or_update
+        - Reference clones against a shared store of PARENT_REPO
 
     Returns:
         - None
     '''
     project_dir = "{}/{}".format(os.getcwd(), project)
-    g = Github(GIT_CONFIG['key'])
-    for repo in g.get_user().get_repos():
-        if is_matching(repo, project, organization):
-            if not os.path.isdir(project_dir):
-                os.mkdir(project_dir)
+    g = ghclient.github(GIT_CONFIG['key'])
+    repos = matching_repos(g, project, organization)
+    if not os.path.isdir(project_dir):
+        os.mkdir(project_dir)
+    store = None
+    if reference:
+        if _parent is None:
+            print("Set PARENT_REPO to clone against the template store")
+            return
+        store = template_store(_parent)
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=GIT_CONFIG['clone_jobs']) as pool:
+        futures = {}
+        for repo in repos:
             split_idx = repo.clone_url.find("github.com")
             repo_url = "{}{}@{}".format(repo.clone_url[:split_idx],
                                         GIT_CONFIG['key'],
                                         repo.clone_url[split_idx:])
-            subprocess.run(["git", "clone", "--depth", "1", repo_url], cwd=project_dir)
+            futures[pool.submit(clone_or_update, repo_url, project_dir,
+                                repo.name, sparse, store)] = repo.name
+        for done, future in enumerate(as_completed(futures), 1):
+            name = futures[future]
+            status, detail = future.result()
+            results[name] = (status, detail)
+            print(f"[{done}/{len(futures)}] {name}: {status} {detail}".rstrip())
+
+    print_summary(results)
+
+
+def utc(t):
+    '''
+    Makes a PyGithub datetime timezone-aware; older versions return naive UTC.
+    '''
+    return t.replace(tzinfo=datetime.timezone.utc) if t.tzinfo is None else t
 
 
-def run_remote(project, organization):
+def org_runners(organization, session=None):
+    '''
+    Lists the self-hosted runners of an organization, following pagination.
+
+    Parameters:
+        - Organization name which owns the runners
+        - Session is a requests session to reuse (see ghclient.session)
+
+    Returns:
+        - List of runner dicts (id, name, status, busy, labels, ...)
+    '''
+    session = session or ghclient.session(GIT_CONFIG['key'])
+    url = f"https://api.github.com/orgs/{organization}/actions/runners?per_page=100"
+    runners = []
+    while url:
+        response = session.get(url)
+        response.raise_for_status()
+        runners += response.json()['runners']
+        url = response.links.get('next', {}).get('url')
+    return runners
+
+
+def dispatch_priority(repo):
+    '''
+    Ranks a repo for run-remote: never graded first, then repos pushed
+    since their last grading run, then the rest.
+
+    Returns:
+        - Tuple sorting in dispatch order; a repo whose runs could not be
+          listed ranks with the repos pushed since grading
+    '''
+    last = None
+    try:
+        for run in repo.get_workflow_runs(event="repository_dispatch"):
+            last = utc(run.created_at)
+            break
+    except (GithubException, requests.RequestException):
+        return (1, repo.name)
+    if last is None:
+        return (0, repo.name)
+    if repo.pushed_at is not None and utc(repo.pushed_at) > last:
+        return (1, repo.name)
+    return (2, repo.name)
+
+
+def dispatch_state(repo, since):
+    '''
+    Checks on a repo dispatched at a given time.
+
+    Returns:
+        - None while its grading run is queued, running or not yet created,
+          or if it could not be checked (it is checked again on the next
+          poll), otherwise the run's conclusion (e.g., 'success', 'failure')
+    '''
+    created = created_filter(since - datetime.timedelta(seconds=5))
+    try:
+        runs = list(repo.get_workflow_runs(event="repository_dispatch",
+                                           created=created))
+    except (GithubException, requests.RequestException):
+        return None
+    if not runs or any(run.status != "completed" for run in runs):
+        return None
+    return runs[0].conclusion or "completed"
+
+
+def run_remote(project, organization, inflight=None):
     '''
     Trigger remote run of repository.
+
+    Repos are dispatched by a scheduler that keeps at most a target number
+    of grading runs queued or running: by default the number of online
+    self-hosted runners of the organization (re-read on every poll; while
+    none is online nothing is dispatched), or
+    GIT_CONFIG['dispatch_inflight'] if that is set. Every
+    GIT_CONFIG['dispatch_poll'] seconds the repos in flight are checked,
+    and the next repos in priority order (see dispatch_priority) are
+    dispatched into the freed capacity, concurrently but within GitHub's
+    rate limits (see ghclient.WriteScheduler). A dispatch whose run has not shown
+    up after GIT_CONFIG['dispatch_start_timeout'] seconds is given up on.
+
     Parameters:
         - Project name to be queried (repo name should contain this)
         - Organization name which should own the repo (if any)
+        - Inflight overrides the target number of runs in flight
 
     Returns:
         - None
     '''
-    project_dir = "{}/{}".format(os.getcwd(), project)
-    g = Github(GIT_CONFIG['key'])
-    for repo in g.get_user().get_repos():
-        if is_matching(repo, project, organization):
-            print(repo.name)
-            client_payload = {}
-            client_payload["password"] = GIT_CONFIG["run_remote_password"]
-            repo.create_repository_dispatch("grading", client_payload)
+    start = time.time()
+    g = ghclient.github(GIT_CONFIG['key'])
+    repos = matching_repos(g, project, organization)
+    with ThreadPoolExecutor(max_workers=GIT_CONFIG['api_jobs']) as pool:
+        ranks = dict(zip([repo.name for repo in repos],
+                         pool.map(dispatch_priority, repos)))
+    pending = sorted(repos, key=lambda repo: ranks[repo.name])
+    never = sum(1 for rank in ranks.values() if rank[0] == 0)
+    print(f"{len(pending)} repos to dispatch, {never} never graded")
+
+    client_payload = {}
+    client_payload["password"] = GIT_CONFIG["run_remote_password"]
+    flight = {}
+    results = {}
+    writes = ghclient.WriteScheduler(len(repos), "dispatches", g, live=False)
+
+    def dispatch(repo):
+        try:
+            writes.call(repo.create_repository_dispatch, "grading", client_payload)
+            return None
+        except (GithubException, ghclient.RateLimited, requests.RequestException) as e:
+            return str(e)
+
+    try:
+        while pending or flight:
+            # Retire the repos whose run finished (or never started).
+            if flight:
+                with ThreadPoolExecutor(max_workers=GIT_CONFIG['api_jobs']) as pool:
+                    states = dict(zip(list(flight), pool.map(
+                        lambda name: dispatch_state(*flight[name]), list(flight))))
+                now = datetime.datetime.now(datetime.timezone.utc)
+                for name, state in states.items():
+                    age = (now - flight[name][1]).total_seconds()
+                    if state is not None:
+                        results[name] = (state, "")
+                    elif age > GIT_CONFIG['dispatch_start_timeout']:
+                        try:
+                            if active_runs(flight[name][0], "repository_dispatch"):
+                                continue
+                        except (GithubException, requests.RequestException):
+                            # Checked again on the next poll.
+                            continue
+                        results[name] = ("failed", "no run started")
+                    else:
+                        continue
+                    del flight[name]
+
+            target = inflight or GIT_CONFIG['dispatch_inflight']
+            online = None
+            if not target:
+                try:
+                    online = sum(1 for r in org_runners(organization)
+                                 if r['status'] == "online")
+                except requests.RequestException:
+                    pass
+                # Fall back to 4 only if the runners could not be listed;
+                # with none online, nothing is dispatched until one is.
+                target = 4 if online is None else online
+
+            batch = pending[:max(0, target - len(flight))]
+            del pending[:len(batch)]
+            if batch:
+                with ThreadPoolExecutor(max_workers=writes.limit) as pool:
+                    errors = list(pool.map(dispatch, batch))
+                for repo, error in zip(batch, errors):
+                    if error is None:
+                        flight[repo.name] = (
+                            repo, datetime.datetime.now(datetime.timezone.utc))
+                    else:
+                        results[repo.name] = ("failed", error)
+
+            runners = "" if online is None else f", {online} runners online"
+            print(f"[{len(results)}/{len(repos)} done] {len(flight)}/{target} "
+                  f"in flight, {len(pending)} waiting{runners}; {writes.status()}")
+            if pending or flight:
+                time.sleep(GIT_CONFIG['dispatch_poll'])
+    except KeyboardInterrupt:
+        print(f"Stopped: {len(pending)} repos not dispatched, "
+              f"{len(flight)} still in flight")
+
+    print_summary(results, problems=("failed", "failure", "timed_out"))
+    print(f"Graded {len(results)} of {len(repos)} repos in "
+          f"{time.time() - start:.0f}s")
+
+
+def parse_time(text):
+    '''
+    Parses a time given on the command line: either relative to now, as a
+    number of minutes, hours or days (e.g., 30m, 2h, 1d), or an ISO 8601
+    date/time (taken as UTC if it has no offset).
 
+    Returns:
+        - Aware UTC datetime
+    '''
+    now = datetime.datetime.now(datetime.timezone.utc)
+    m = re.fullmatch(r"(\d+)([mhd])", text.strip())
+    if m:
+        unit = {'m': "minutes", 'h': "hours", 'd': "days"}[m.group(2)]
+        return now - datetime.timedelta(**{unit: int(m.group(1))})
+    t = datetime.datetime.fromisoformat(text.strip())
+    if t.tzinfo is None:
+        t = t.replace(tzinfo=datetime.timezone.utc)
+    return t.astimezone(datetime.timezone.utc)
+
+
+def created_filter(since=None, until=None):
+    '''
+    Builds the 'created' query of the workflow runs API for a time window.
 
-def cancel_remote(project, organization):
+    Parameters:
+        - Since and until are datetimes; either may be None
+
+    Returns:
+        - Query string, or None for no window
     '''
-    Trigger remote run of repository.
+    fmt = "%Y-%m-%dT%H:%M:%SZ"
+    if since and until:
+        return f"{since.strftime(fmt)}..{until.strftime(fmt)}"
+    if since:
+        return f">={since.strftime(fmt)}"
+    if until:
+        return f"<={until.strftime(fmt)}"
+    return None
+
+
+# Workflow run statuses before a run starts: queued, or held by a
+# concurrency group, an environment approval or a pending request.
+QUEUED_STATUSES = ("queued", "waiting", "pending", "requested")
+
+
+def active_runs(repo, event=None, created=None):
+    '''
+    Lists a repo's workflow runs that are waiting (see QUEUED_STATUSES) or in
+    progress. Status, event and creation time are filtered by the API, so
+    finished runs are never paged through.
+
+    Parameters:
+        - Repo is the github Repository
+        - Event limits the runs to one trigger (e.g., repository_dispatch)
+        - Created is a creation time query (see created_filter)
+
+    Returns:
+        - List of WorkflowRun objects
+    '''
+    runs = []
+    for status in QUEUED_STATUSES + ("in_progress",):
+        kwargs = {'status': status}
+        if event:
+            kwargs['event'] = event
+        if created:
+            kwargs['created'] = created
+        runs.extend(repo.get_workflow_runs(**kwargs))
+    return runs
+
+
+def cancel_run(writes, run):
+    '''
+    Cancels one workflow run, through the write scheduler (see
+    ghclient.WriteScheduler).
+
+    Returns:
+        - Tuple of (status, detail) where status is 'cancelled' or 'failed'
+    '''
+    try:
+        if writes.call(run.cancel):
+            return "cancelled", ""
+        return "failed", "cancel refused"
+    except (ghclient.RateLimited, requests.RequestException) as e:
+        return "failed", str(e)
+    except GithubException as e:
+        # 409: the run finished in the meantime.
+        return "failed", str(e)
+
+
+def cancel_remote(project, organization, event=None, since=None, until=None):
+    '''
+    Cancels the queued and in-progress remote runs of the matching repos.
+    The runs are listed concurrently, by a pool of GIT_CONFIG['api_jobs']
+    workers, and cancelled as fast as GitHub's rate limits allow (see
+    ghclient.WriteScheduler).
+
     Parameters:
         - Project name to be queried (repo name should contain this)
         - Organization name which should own the repo (if any)
+        - Event only cancels runs with that trigger (e.g., repository_dispatch)
+        - Since and until only cancel runs created in that window (datetimes)
 
     Returns:
         - None
     '''
-    project_dir = "{}/{}".format(os.getcwd(), project)
-    g = Github(GIT_CONFIG['key'])
-    for repo in g.get_user().get_repos():
-        if is_matching(repo, project, organization):
-            runs = repo.get_workflow_runs()
-            for run in runs:
-                if (run.status != "completed"):
-                    if run.cancel():
-                        print(f"Cancelled run {repo.name}")
+    start = time.time()
+    g = ghclient.github(GIT_CONFIG['key'])
+    repos = matching_repos(g, project, organization)
+    created = created_filter(since, until)
+    results = {}
+    with ThreadPoolExecutor(max_workers=GIT_CONFIG['api_jobs']) as pool:
+        futures = {pool.submit(active_runs, repo, event, created): repo
+                   for repo in repos}
+        runs = []
+        for future in as_completed(futures):
+            repo = futures[future]
+            try:
+                runs += [(repo, run) for run in future.result()]
+            except (GithubException, requests.RequestException) as e:
+                results[repo.name] = ("failed", str(e))
+        listed = time.time() - start
+
+    with ghclient.WriteScheduler(len(runs), "cancels", g) as writes, \
+            ThreadPoolExecutor(max_workers=writes.limit) as pool:
+        futures = {pool.submit(cancel_run, writes, run): f"{repo.name}#{run.id}"
+                   for repo, run in runs}
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+            if results[futures[future]][0] == "cancelled":
+                writes.log(f"Cancelled run {futures[future]}")
+
+    print_summary(results)
+    cancelled = sum(1 for status, _ in results.values() if status == "cancelled")
+    print(f"Cancelled {cancelled} of {len(runs)} active runs across "
+          f"{len(repos)} repos; listed in {listed:.1f}s, done in "
+          f"{time.time() - start:.1f}s")
+
+
+def latest_runs(session, full_name, events=("push", "repository_dispatch"),
+                per_event=20):
+    '''
+    Fetches the newest workflow runs of a repo: one page per event, so a
+    burst of pushes cannot hide the latest grading run. Each page is
+    revalidated through the shared HTTP cache, so an unchanged repo costs
+    304s that do not count against the rate limit.
 
+    Parameters:
+        - Session is the requests session (see ghclient.session)
+        - Full_name is owner/repo
+        - Events are the triggers to fetch runs of
+        - Per_event is the number of newest runs fetched per event (the
+          pending count only sees those)
 
-def run_remote_status(project, organization):
+    Returns:
+        - Tuple of (list of trimmed runs, newest first within each event,
+          True if changed since the last poll)
+    '''
+    runs = []
+    changed = False
+    for event in events:
+        response = session.get(
+            f"https://api.github.com/repos/{full_name}/actions/runs"
+            f"?event={event}&per_page={per_event}")
+        response.raise_for_status()
+        changed |= not response.from_cache
+        runs += [{k: run.get(k) for k in ("id", "event", "status", "conclusion",
+                                          "created_at", "updated_at",
+                                          "run_started_at")}
+                 for run in response.json()['workflow_runs']]
+    return runs, changed
+
+
+def run_state(run):
+    '''
+    Buckets a run for the status table.
+    '''
+    if run is None:
+        return "none"
+    if run['status'] != "completed":
+        return "queued" if run['status'] in QUEUED_STATUSES else "in_progress"
+    return {'success': "succeeded", 'failure': "failed"}.get(
+        run['conclusion'], "other")
+
+
+def run_remote_status(project, organization, slowest=5):
     '''
     Get status of latest remote runs
+
+    Takes one snapshot of the latest push and repository_dispatch runs of
+    every matching repo: one page of runs per repo and event (see
+    latest_runs), fetched concurrently and revalidated through the shared
+    HTTP cache (see ghclient), and prints an aggregate table instead of a
+    report per repo.
+
     Parameters:
         - Project name to be queried (repo name should contain this)
         - Organization name which should own the repo (if any)
+        - Slowest is the number of slowest runs listed
 
     Returns:
         - None
     '''
-    project_dir = "{}/{}".format(os.getcwd(), project)
-    g = Github(GIT_CONFIG['key'])
-    all_jobs = 0
-    for repo in g.get_user().get_repos():
-        if is_matching(repo, project, organization):
-            print(repo.name)
-            runs = repo.get_workflow_runs()
-            push_runs = [item for item in runs if item.event == "push"]
-            repository_runs = [
-                item for item in runs if item.event == "repository_dispatch"]
-#            push_runs.sort(key=lambda x: x.created_at)
-#            repository_runs.sort(key=lambda x: x.created_at)
-            queued = 0
-            if push_runs:
-                latest_run = max(push_runs, key=lambda x: x.created_at)
-                print(latest_run.event, latest_run.created_at,
-                      latest_run.conclusion, latest_run.status)
-
-            if repository_runs:
-                latest_run = max(repository_runs, key=lambda x: x.created_at)
-                print(
-                    latest_run.event, latest_run.created_at, latest_run.conclusion, latest_run.status)
-            incomplete = [x for x in push_runs if x.status != "completed"]
-            incomplete.extend(
-                [x for x in repository_runs if x.status != "completed"])
-
-            if incomplete:
-                number_of_incomplete_jobs = len(incomplete)
-                all_jobs = all_jobs + number_of_incomplete_jobs
-                print(f"{number_of_incomplete_jobs} jobs pending")
-            else:
-                print("0 jobs pending")
-    print(f"Total:{all_jobs} pending")
+    start = time.time()
+    g = ghclient.github(GIT_CONFIG['key'])
+    repos = matching_repos(g, project, organization)
+    session = ghclient.session(GIT_CONFIG['key'])
+    latest = {}
+    changed = 0
+    failed = []
+    with ThreadPoolExecutor(max_workers=GIT_CONFIG['api_jobs']) as pool:
+        futures = {pool.submit(latest_runs, session, repo.full_name): repo
+                   for repo in repos}
+        for future in as_completed(futures):
+            repo = futures[future]
+            try:
+                latest[repo.full_name], fresh = future.result()
+                changed += fresh
+            except requests.RequestException as e:
+                failed.append(f"{repo.name}: {e}")
+
+    states = ("queued", "in_progress", "succeeded", "failed", "other", "none")
+    table = {event: dict.fromkeys(states, 0)
+             for event in ("push", "repository_dispatch")}
+    pending = 0
+    durations = []
+    now = datetime.datetime.now(datetime.timezone.utc)
+    for repo in repos:
+        runs = latest.get(repo.full_name, [])
+        pending += sum(1 for run in runs if run['event'] in table
+                       and run['status'] != "completed")
+        for event in table:
+            run = next((run for run in runs if run['event'] == event), None)
+            table[event][run_state(run)] += 1
+            if run is not None:
+                began = datetime.datetime.fromisoformat(
+                    (run['run_started_at'] or run['created_at']).replace("Z", "+00:00"))
+                ended = now if run['status'] != "completed" else \
+                    datetime.datetime.fromisoformat(run['updated_at'].replace("Z", "+00:00"))
+                durations.append(((ended - began).total_seconds(), repo.name,
+                                  event, run_state(run)))
+
+    print(f"{'latest run':<20}" + "".join(f"{s:>12}" for s in states))
+    for event, counts in table.items():
+        print(f"{event:<20}" + "".join(f"{counts[s]:>12}" for s in states))
+    print("Slowest runs:")
+    for seconds, name, event, state in sorted(durations, reverse=True)[:slowest]:
+        print(f"    {name} {event} {state} {seconds / 60:.1f} min")
+    for problem in failed:
+        print(f"    could not fetch {problem}")
+    print(f"Total:{pending} pending")
+    print(f"{len(repos)} repos, {changed} changed since the last poll, "
+          f"in {time.time() - start:.1f}s")
+
+
+def remove_runner(writes, session, organization, runner):
+    '''
+    Deletes one self-hosted runner, through the write scheduler (see
+    ghclient.WriteScheduler).
+
+    Returns:
+        - Tuple of (status, detail) where status is 'removed' or 'failed'
+    '''
+    def delete():
+        response = session.delete(
+            f"https://api.github.com/orgs/{organization}/actions/runners/{runner['id']}")
+        response.raise_for_status()
+
+    try:
+        writes.call(delete)
+        return "removed", ""
+    except (requests.RequestException, ghclient.RateLimited) as e:
+        return "failed", str(e)
 
-def force_remove_runners(organization):
+
+def force_remove_runners(organization, status=None, label=None, name=None):
     '''
     Removes runners forcibly; stop docker instances before invoking.
+
+    Every page of runners is listed, and the selected runners are deleted
+    concurrently over one keep-alive session, as fast as GitHub's rate
+    limits allow (see ghclient.WriteScheduler).
+
     Parameters
         - Organization name which should own the repo (if any)
+        - Status only removes runners with that status (online/offline)
+        - Label only removes runners carrying that label
+        - Name only removes runners whose name matches this glob pattern
     Returns:
         - None
     '''
+    start = time.time()
+    session = ghclient.session(GIT_CONFIG['key'])
+    runners = org_runners(organization, session)
+    selected = [r for r in runners
+                if (status is None or r['status'] == status)
+                and (label is None or label in [l['name'] for l in r.get('labels', [])])
+                and (name is None or fnmatch.fnmatch(r['name'], name))]
+    listed = time.time() - start
+
+    results = {}
+    with ghclient.WriteScheduler(len(selected), "runner removals") as writes, \
+            ThreadPoolExecutor(max_workers=writes.limit) as pool:
+        futures = {pool.submit(remove_runner, writes, session, organization, r):
+                   f"{r['name']} (id {r['id']})" for r in selected}
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+            if results[futures[future]][0] == "removed":
+                writes.log("Removed runner: " + futures[future])
+
+    print_summary(results)
+    print(f"Removed {sum(1 for s, _ in results.values() if s == 'removed')} of "
+          f"{len(selected)} selected runners ({len(runners)} in total); "
+          f"listed in {listed:.1f}s, done in {time.time() - start:.1f}s")
 
-    auth_token = format(GIT_CONFIG['key'])
-    headers = {
-    'accept': 'application/vnd.github.everest-preview+json',
-    'authorization': f'token {auth_token}',
-    }
-    params = (
-    ('per_page', '100'),
-    )
-
-    response = requests.get(f'https://api.github.com/orgs/{organization}/actions/runners', headers=headers, params=params)
-
-    for r in response.json()['runners']:
-        print("Removing runner:" + r['name'] + " with id:" + str(r['id']))
-        headers = {
-        'authorization': f'token {auth_token}',
-        }
-        runner_id = r['id']
-        response = requests.delete(f'https://api.github.com/orgs/{organization}/actions/runners/{runner_id}', headers=headers, params=params)
-
- #   print(response.json())
-    
-#    curl -s -X DELETE ${base_api_url}/${runner_scope}/actions/runners/${runner_id} -H "authorization: token ${RUNNER_CFG_PAT}"
 
 if __name__ == "__main__":
 
@@ -763,20 +2518,54 @@ if __name__ == "__main__":
     "set_remove",
     "push-grade-sheet",
     "moss",
+    "similarity",
     "run-local",
     "run-remote",
     "run-remote-status",
     "add-commit",
     "force-remove-runners",
-    "compile-check"
+    "compile-check",
+    "grep-logs"
     ], help= "")
     parser.add_argument('assignment', help= "Github classroom assignment prefix (e.g., assignment-1- . Pay attention to the - at the end)")
     parser.add_argument('-o','--organization', help= "github organization", required=True)
+    parser.add_argument('pattern', nargs='?', help= "grep-logs: regular expression to search the run-local logs for")
+    parser.add_argument('-j','--jobs', type=int, help= "number of parallel workers (default: CLONE_JOBS/PUSH_JOBS/RUN_JOBS in config.ini)")
+    parser.add_argument('--sparse', nargs='?', const='', metavar='MANIFEST', help= "clone: blob-less sparse clone of only the files in MANIFEST (e.g., ASS3 for MOSS_FILES/ASS3.moss; default MOSS_FILES in config.ini)")
+    parser.add_argument('--reference', action='store_true', help= "clone: share objects with a local mirror of PARENT_REPO")
+    parser.add_argument('--timeout', type=int, help= "run-local: per-repo wall-clock timeout in seconds (default: RUN_TIMEOUT in config.ini)")
+    parser.add_argument('--no-cache', action='store_true', help= "run-local/moss: rerun (restage) every repo instead of reusing cached results")
+    parser.add_argument('--manifest', metavar='MANIFEST', help= "moss: stage the files in MANIFEST (e.g., ASS3_GEMM for MOSS_FILES/ASS3_GEMM.moss) instead of MOSS_FILES")
+    parser.add_argument('--corpus', help= "similarity: cross-term corpus to check against (default: the assignment prefix)")
+    parser.add_argument('--archive', metavar='TERM', help= "similarity: add the staged submissions to the corpus as TERM (e.g., 2024-fall)")
+    parser.add_argument('--subtract-template', action='store_true', help= "moss/compile-check: ignore lines that come unchanged from PARENT_REPO")
+    parser.add_argument('--restart', action='store_true', help= "push actions: ignore the journal of an interrupted run and start over")
+    parser.add_argument('--inflight', type=int, help= "run-remote: grading runs kept in flight (default: DISPATCH_INFLIGHT in config.ini, or one per online runner)")
+    parser.add_argument('--event', help= "cancel-remote: only cancel runs triggered by EVENT (e.g., repository_dispatch, push)")
+    parser.add_argument('--since', help= "cancel-remote: only cancel runs created since then (e.g., 30m, 2h, 1d or an ISO date/time, UTC)")
+    parser.add_argument('--until', help= "cancel-remote: only cancel runs created until then (same format as --since)")
+    parser.add_argument('--runner-status', choices=["online", "offline"], help= "force-remove-runners: only remove runners with this status")
+    parser.add_argument('--label', help= "force-remove-runners: only remove runners with this label")
+    parser.add_argument('--name', help= "force-remove-runners: only remove runners whose name matches this glob (e.g., 'ephemeral-*')")
+    parser.add_argument('--refresh-index', action='store_true', help= "revalidate the local repo index even if it is still fresh")
 
     args = parser.parse_args()
     action = args.action
     project = args.assignment
     organization = args.organization
+    if args.refresh_index:
+        GIT_CONFIG['index_ttl'] = 0
+    if args.jobs:
+        GIT_CONFIG['clone_jobs'] = args.jobs
+        GIT_CONFIG['push_jobs'] = args.jobs
+        GIT_CONFIG['run_jobs'] = args.jobs
+        GIT_CONFIG['api_jobs'] = args.jobs
+    if args.restart:
+        GIT_CONFIG['push_resume'] = False
+    if args.timeout:
+        GIT_CONFIG['run_timeout'] = args.timeout
+    if args.no_cache:
+        GIT_CONFIG['run_cache'] = False
     # if len(sys.argv) < 3:
     #     print_help()
     #     sys.exit(1)
@@ -798,19 +2587,30 @@ if __name__ == "__main__":
     if action == "ls":
         list_matching(project, organization)
     elif action == "clone":
-        clone_matching(project, organization)
+        sparse = None
+        if args.sparse is not None:
+            sparse = read_manifest(args.sparse) if args.sparse else _FILES
+        clone_matching(project, organization, sparse, args.reference)
     elif action == "run-remote":
         print("Are you sure you trigger remote runs for respositories. This may dump data to remote folder. Make sure you clean folder before running.")
         print("Type 'YES' to confirm")
         ans = input()
         if ans == "YES":
-            run_remote(project, organization)
+            run_remote(project, organization, args.inflight)
     elif action == "cancel-remote":
-        print("Are you sure you want to CANCEL all remote runs for repositories. THIS WILL STOP ALL RUNS")
+        since = parse_time(args.since) if args.since else None
+        until = parse_time(args.until) if args.until else None
+        window = ""
+        if args.event:
+            window += f" triggered by {args.event}"
+        if since or until:
+            window += f" created {created_filter(since, until)}"
+        print("Are you sure you want to CANCEL all queued and running remote runs"
+              f"{window} for repositories. THIS WILL STOP ALL THESE RUNS")
         print("Type 'YES' to confirm")
         ans = input()
         if ans == "YES":
-            cancel_remote(project, organization)
+            cancel_remote(project, organization, args.event, since, until)
     elif action == "run-remote-status":
         run_remote_status(project, organization)
     elif action == "set_readonly":
@@ -845,9 +2645,15 @@ if __name__ == "__main__":
     elif action == "moss":
         if organization is not None:
             print("Organization does not affect mossing")
-        moss(project, comment=True)
+        subtractor = make_subtractor() if args.subtract_template else None
+        manifest = read_manifest(args.manifest) if args.manifest else None
+        moss(project, comment=True, subtractor=subtractor, manifest=manifest,
+             incremental=not args.no_cache)
+    elif action == "similarity":
+        similarity_check(args.corpus or project, args.archive)
     elif action == "compile-check":
-        compile_check(project)
+        subtractor = make_subtractor() if args.subtract_template else None
+        compile_check(project, subtractor)
     elif action == "update-from-template":
         if organization is not None:
             print("Organization does not affect pushing")
@@ -864,14 +2670,23 @@ if __name__ == "__main__":
         if organization is not None:
             print("Organization does not affect mossing")
         run(project)
+    elif action == "grep-logs":
+        if args.pattern is None:
+            print("Give the pattern to search for, e.g. grep-logs assignment-x- 'Segmentation fault'")
+            sys.exit(1)
+        grep_logs(args.pattern)
     elif action == "add-commit":
         if organization is not None:
             print("Organization does not affect commit")
         add_commit_push_all(project)
     elif action == "force-remove-runners":
-        print("Are you sure you want force remove runners for" + "Organization:" + organization + " (YES/NO)")
+        selection = " ".join(f"{k}={v}" for k, v in (("status", args.runner_status),
+                             ("label", args.label), ("name", args.name)) if v)
+        print("Are you sure you want force remove runners for" + "Organization:" + organization
+              + (f" with {selection}" if selection else "") + " (YES/NO)")
         ans = input()
         if ans == "YES":
-            force_remove_runners(organization)
+            force_remove_runners(organization, args.runner_status,
+                                 args.label, args.name)
     else:
         print_help()
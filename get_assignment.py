@@ -1,4 +1,4 @@
-import github2sfuid.sfuid2githubid as gs
+from github2sfuid import roster
 import argparse
 
 
@@ -14,12 +14,13 @@ parser.add_argument("-A", dest="assignment",
 
 opts = parser.parse_args()
 id_file = opts.sfuid
-gs.fillmap(id_file)
+students = roster.load(id_file)
 id = 0
 while id != -1:
-    id = input("Enter sfu id: ")
-    if gs.getgithubid(id):
-        githubid = gs.getgithubid(id)["GithubID"]
+    id = input("Enter sfu id or student number: ")
+    row = students.by_sfuid(id) or students.by_number(id)
+    if row:
+        githubid = row["GithubID"]
         print(f"https://github.com/CMPT-295-SFU/{opts.assignment}-{githubid}/actions/")
     else:
         print("Not found")
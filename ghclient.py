@@ -0,0 +1,569 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import hashlib
+import threading
+import configparser
+
+import urllib.parse
+
+import requests
+from requests.structures import CaseInsensitiveDict
+from github import Github
+
+# Settings, read from the DEFAULT section of config.ini like the other
+# optional knobs; see config.ini for their meaning.
+_settings = configparser.ConfigParser()
+_settings.read('config.ini')
+_settings = _settings['DEFAULT']
+
+CLIENT_CONFIG = {
+    # Directory of the HTTP cache; empty disables it.
+    'cache_dir': _settings.get('HTTP_CACHE_DIR', '.gcassist/http'),
+    # Cache entries unused for this many days are pruned; 0 keeps them.
+    'cache_max_age': int(_settings.get('HTTP_CACHE_MAX_AGE', '14')),
+    # Size of the cache in MB beyond which the least recently used entries
+    # are pruned; 0 means no limit.
+    'cache_max_mb': int(_settings.get('HTTP_CACHE_MAX_MB', '256')),
+    # Connections kept open to api.github.com.
+    'pool_size': int(_settings.get('API_POOL_SIZE', '16')),
+    # Seconds before a request is given up on.
+    'timeout': int(_settings.get('API_TIMEOUT', '30')),
+    # Most concurrent write calls (see WriteScheduler).
+    'write_jobs': int(_settings.get('WRITE_JOBS', '8')),
+    # Times a write is retried after hitting a rate limit.
+    'write_retries': int(_settings.get('WRITE_RETRIES', '5')),
+    # Requests left in the hourly budget below which writes wait for the reset.
+    'rate_reserve': int(_settings.get('RATE_RESERVE', '50')),
+}
+
+# Response headers kept with a cached body.
+_CACHED_HEADERS = ("content-type", "etag", "last-modified", "link")
+
+# Query parameters holding a time window (e.g., created=>=2024-...), which
+# make a new URL on every poll; such requests are not cached.
+_TIME_PARAMS = frozenset(("created", "since", "until", "before", "after"))
+
+# Entries stored between two prunes of the cache by one process.
+_PRUNE_EVERY = 1000
+
+
+def prune_cache(cache_dir, max_age_days=None, max_mb=None):
+    '''
+    Deletes cache entries unused for max_age_days, then the least recently
+    used ones until the cache is below max_mb. An entry's modification
+    time is its last use (a revalidation touches it).
+
+    Parameters:
+        - Cache_dir is the cache directory
+        - Max_age_days and max_mb default to CLIENT_CONFIG; 0 disables each
+
+    Returns:
+        - Number of entries deleted
+    '''
+    max_age_days = CLIENT_CONFIG['cache_max_age'] if max_age_days is None else max_age_days
+    max_mb = CLIENT_CONFIG['cache_max_mb'] if max_mb is None else max_mb
+    entries = []
+    try:
+        with os.scandir(cache_dir) as it:
+            for entry in it:
+                if "." in entry.name:
+                    continue  # an entry being written
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry.path))
+    except FileNotFoundError:
+        return 0
+
+    doomed = []
+    if max_age_days:
+        cutoff = time.time() - max_age_days * 86400
+        doomed = [e for e in entries if e[0] < cutoff]
+        entries = [e for e in entries if e[0] >= cutoff]
+    if max_mb:
+        entries.sort()
+        size = sum(e[1] for e in entries)
+        while entries and size > max_mb * 1024 * 1024:
+            size -= entries[0][1]
+            doomed.append(entries.pop(0))
+    for _, _, path in doomed:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    return len(doomed)
+
+
+def cacheable(url):
+    '''
+    Whether GETs of a URL are worth caching: not if its query has a time
+    window, which changes on every call.
+    '''
+    query = urllib.parse.urlsplit(url).query
+    return not any(name in _TIME_PARAMS
+                   for name, _ in urllib.parse.parse_qsl(query, keep_blank_values=True))
+
+
+def rate_headers(headers):
+    '''
+    Reads GitHub's rate limit headers.
+
+    Returns:
+        - Tuple of (remaining, limit, reset epoch), or None if absent
+    '''
+    try:
+        return (int(headers['x-ratelimit-remaining']),
+                int(headers['x-ratelimit-limit']),
+                int(headers['x-ratelimit-reset']))
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+class CachingAdapter(requests.adapters.HTTPAdapter):
+    '''
+    Connection pool that revalidates GET requests against an on-disk cache.
+
+    A response carrying an ETag or Last-Modified is stored under a hash of
+    its URL, Accept header and token. The next GET of that URL is sent with
+    If-None-Match / If-Modified-Since; if GitHub answers 304 (which does not
+    count against the rate limit) the stored response is returned instead,
+    as a 200 with from_cache set. Requests that already carry conditional
+    headers, or whose query has a time window (see cacheable), are passed
+    through untouched. Every response has from_cache, False unless it was
+    served from the cache. The cache is pruned (see prune_cache) when the
+    pool is created and every _PRUNE_EVERY stored entries.
+    '''
+
+    def __init__(self, cache_dir, **kwargs):
+        super().__init__(**kwargs)
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+        if cache_dir:
+            prune_cache(cache_dir)
+
+    def _note_rate(self, response):
+        global _rate
+        rate = rate_headers(response.headers)
+        if rate is not None:
+            _rate = rate
+        return response
+
+    def _path(self, request):
+        key = "\0".join((request.url, request.headers.get("Accept", ""),
+                         request.headers.get("Authorization", "")))
+        return os.path.join(self.cache_dir, hashlib.sha256(key.encode()).hexdigest())
+
+    def send(self, request, **kwargs):
+        if request.method != "GET" or not self.cache_dir or \
+                "If-None-Match" in request.headers or \
+                "If-Modified-Since" in request.headers or \
+                not cacheable(request.url):
+            response = self._note_rate(super().send(request, **kwargs))
+            response.from_cache = False
+            return response
+
+        path = self._path(request)
+        entry = None
+        if os.path.isfile(path):
+            try:
+                with open(path) as f:
+                    entry = json.load(f)
+            except (OSError, ValueError):
+                entry = None
+        if entry is not None:
+            if entry['headers'].get('etag'):
+                request.headers["If-None-Match"] = entry['headers']['etag']
+            if entry['headers'].get('last-modified'):
+                request.headers["If-Modified-Since"] = entry['headers']['last-modified']
+
+        response = self._note_rate(super().send(request, **kwargs))
+        if response.status_code == 304 and entry is not None:
+            self.hits += 1
+            response.content  # release the connection to the pool
+            try:
+                os.utime(path)  # recently used, see prune_cache
+            except OSError:
+                pass
+            cached = requests.Response()
+            cached.status_code = 200
+            cached.reason = "OK"
+            cached.headers = CaseInsensitiveDict(entry['headers'])
+            # Rate limit headers are those of the revalidation.
+            cached.headers.update({k: v for k, v in response.headers.items()
+                                   if k.lower().startswith("x-ratelimit")})
+            cached._content = entry['body'].encode("utf-8")
+            cached.encoding = "utf-8"
+            cached.url = request.url
+            cached.request = request
+            cached.connection = self
+            cached.elapsed = response.elapsed
+            cached.from_cache = True
+            return cached
+
+        self.misses += 1
+        response.from_cache = False
+        if response.status_code == 200 and (
+                "ETag" in response.headers or "Last-Modified" in response.headers):
+            try:
+                body = response.content.decode("utf-8")
+            except UnicodeDecodeError:
+                return response
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}"
+            with open(tmp, "w") as f:
+                json.dump({'url': request.url, 'stored': time.time(),
+                           'headers': {k: response.headers[k] for k in _CACHED_HEADERS
+                                       if k in response.headers},
+                           'body': body}, f)
+            os.replace(tmp, path)
+            self.stored += 1
+            if self.stored % _PRUNE_EVERY == 0:
+                prune_cache(self.cache_dir)
+        return response
+
+
+# (remaining, limit, reset epoch) of the latest API response, or None.
+_rate = None
+_adapters = {}
+_sessions = {}
+_lock = threading.RLock()
+
+
+def rate_limit():
+    '''
+    Returns the rate limit budget seen on the latest response of any pool.
+
+    Returns:
+        - Tuple of (remaining, limit, reset epoch), or None
+    '''
+    return _rate
+
+
+def adapter(retry=None):
+    '''
+    Returns the process-wide caching connection pool for a retry policy.
+    Pools are never closed, so keep-alive connections outlive the sessions
+    they are mounted on.
+
+    Parameters:
+        - Retry is the max_retries of the pool: None, a number, or a
+          urllib3 Retry (e.g., PyGithub's GithubRetry)
+    '''
+    key = retry if retry is None or isinstance(retry, int) else id(retry)
+    with _lock:
+        if key not in _adapters:
+            pool = CachingAdapter(CLIENT_CONFIG['cache_dir'],
+                                  max_retries=0 if retry is None else retry,
+                                  pool_connections=1,
+                                  pool_maxsize=CLIENT_CONFIG['pool_size'])
+            # The retry is kept alive with its pool, so its id is not reused.
+            _adapters[key] = (retry, pool)
+        return _adapters[key][1]
+
+
+class _Session(requests.Session):
+    def request(self, *args, **kwargs):
+        kwargs.setdefault("timeout", CLIENT_CONFIG['timeout'])
+        return super().request(*args, **kwargs)
+
+
+def session(key):
+    '''
+    Returns the shared requests session for the GitHub REST API of a token:
+    authenticated, pooled and cached (see CachingAdapter). Safe to share
+    between threads.
+
+    Parameters:
+        - Key is the GitHub token
+
+    Returns:
+        - requests.Session
+    '''
+    with _lock:
+        if key not in _sessions:
+            s = _Session()
+            s.mount("https://", adapter())
+            s.headers.update({
+                'accept': 'application/vnd.github+json',
+                'authorization': f"token {key}",
+            })
+            _sessions[key] = s
+        return _sessions[key]
+
+
+def _route_pygithub():
+    '''
+    Sends PyGithub's HTTPS traffic through the caching pool as well, where
+    the installed PyGithub lets its connection class be replaced.
+
+    Injecting a connection class turns off PyGithub's connection reuse, so
+    it is turned back on: each client keeps one connection, shared by its
+    threads, and the pool is mounted on it once. Closing the connection
+    never closes the shared pool. The pool keeps the retry policy of the
+    connection (GithubRetry handles 5xx and rate limits).
+    '''
+    try:
+        from github.Requester import (Requester, HTTPRequestsConnectionClass,
+                                      HTTPSRequestsConnectionClass)
+    except ImportError:
+        return
+    if not hasattr(Requester, "injectConnectionClasses") or \
+            not hasattr(Requester, "_Requester__persist"):
+        return
+
+    class CachedConnection(HTTPSRequestsConnectionClass):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            if hasattr(self, "session"):
+                self.session.mount("https://", adapter(getattr(self, "retry", None)))
+
+        def close(self):
+            if not hasattr(self, "session"):
+                return super().close()
+            shared = {pool for _, pool in _adapters.values()}
+            for mounted in self.session.adapters.values():
+                if mounted not in shared:
+                    mounted.close()
+
+    Requester.injectConnectionClasses(HTTPRequestsConnectionClass, CachedConnection)
+    Requester._Requester__persist = True
+
+
+_route_pygithub()
+
+
+def github(key):
+    '''
+    Returns a PyGithub client sharing the connection pool and HTTP cache.
+
+    Parameters:
+        - Key is the GitHub token
+
+    Returns:
+        - github.Github
+    '''
+    return Github(key, per_page=100, timeout=CLIENT_CONFIG['timeout'],
+                  pool_size=CLIENT_CONFIG['pool_size'])
+
+
+class RateLimited(Exception):
+    '''
+    Raised by WriteScheduler.call when a write still hits a rate limit
+    after CLIENT_CONFIG['write_retries'] retries.
+    '''
+
+
+def rate_limit_wait(error):
+    '''
+    Tells whether an API error is a rate limit, primary or secondary.
+
+    Parameters:
+        - Error is a github.GithubException or requests.HTTPError
+
+    Returns:
+        - Seconds to wait before retrying (0 if GitHub did not say), or
+          None if the error is not a rate limit
+    '''
+    response = getattr(error, "response", None)
+    if response is not None:
+        status, headers, text = response.status_code, response.headers, response.text
+    else:
+        status = getattr(error, "status", None)
+        headers = getattr(error, "headers", None) or {}
+        text = str(getattr(error, "data", ""))
+    headers = CaseInsensitiveDict(headers)
+    if status not in (403, 429):
+        return None
+    if headers.get("retry-after"):
+        try:
+            return max(0, int(headers["retry-after"]))
+        except ValueError:
+            return 0
+    rate = rate_headers(headers)
+    if rate is not None and rate[0] == 0:
+        return max(0, rate[2] - time.time()) + 1
+    if status == 429 or "rate limit" in text.lower():
+        return 0
+    return None
+
+
+class WriteScheduler:
+    '''
+    Runs GitHub write calls from many threads at a concurrency that adapts
+    to GitHub's limits (additive increase, multiplicative decrease).
+
+    Writes start at two in flight. Every successful write raises the
+    window by about one per round trip, up to CLIENT_CONFIG['write_jobs'].
+    A 403/429 rate limit response halves the window, pauses all writes for
+    its Retry-After (or until the budget resets, or a minute, doubling if
+    it keeps happening) and retries the write. When the hourly budget read
+    from the rate limit headers drops to CLIENT_CONFIG['rate_reserve'],
+    writes wait for the reset. Progress and the remaining budget are shown
+    on one live status line on stderr.
+    '''
+
+    def __init__(self, total=None, label="writes", client=None, live=None):
+        '''
+        Parameters:
+            - Total is the number of writes expected, for the status line
+            - Label names the writes on the status line
+            - Client is the github.Github the writes go through, used for
+              the budget when its traffic does not pass through adapter()
+              (see rate_limit)
+            - Live redraws the status line in place (default: if stderr is
+              a terminal); otherwise it is printed only when writes back off
+        '''
+        self.limit = max(1, CLIENT_CONFIG['write_jobs'])
+        self.window = min(2.0, self.limit)
+        self.total = total
+        self.label = label
+        self.client = client
+        self.running = 0
+        self.done = 0
+        self.backoffs = 0
+        self.paused_until = 0.0
+        self.penalty = 60
+        self.rate = None
+        self._cond = threading.Condition()
+        self._shown = 0.0
+        self._live = sys.stderr.isatty() if live is None else live
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.show(force=True)
+        if self._live:
+            print(file=sys.stderr)
+        return False
+
+    def _budget(self):
+        rate = rate_limit()
+        if rate is None and self.client is not None:
+            try:
+                remaining, limit = self.client.rate_limiting
+                rate = (remaining, limit, int(self.client.rate_limiting_resettime))
+            except Exception:
+                rate = None
+        if rate is not None:
+            self.rate = rate
+
+    def _acquire(self):
+        with self._cond:
+            while True:
+                now = time.time()
+                wait = self.paused_until - now
+                if self.rate is not None and self.rate[0] <= CLIENT_CONFIG['rate_reserve'] \
+                        and self.rate[2] > now:
+                    wait = max(wait, self.rate[2] - now + 1)
+                if wait <= 0 and self.running < int(self.window):
+                    self.running += 1
+                    return
+                self._cond.wait(timeout=wait if wait > 0 else None)
+
+    def _release(self, ok):
+        with self._cond:
+            self.running -= 1
+            if ok:
+                self.done += 1
+                self.window = min(self.limit, self.window + 1 / self.window)
+                self.penalty = 60
+            self._cond.notify_all()
+
+    def _back_off(self, seconds):
+        with self._cond:
+            now = time.time()
+            # Writes that were already in flight fail together; only the
+            # first of them shrinks the window and sets the pause.
+            if now >= self.paused_until:
+                self.backoffs += 1
+                self.window = max(1.0, self.window / 2)
+                self.paused_until = now + (seconds or self.penalty)
+                if not seconds:
+                    self.penalty = min(self.penalty * 2, 900)
+                self._cond.notify_all()
+                return True
+            return False
+
+    def call(self, fn, *args, **kwargs):
+        '''
+        Runs one write, waiting for a slot and retrying rate limits.
+
+        Parameters:
+            - Fn is the write (e.g., repo.create_repository_dispatch),
+              called with the remaining arguments
+
+        Returns:
+            - Whatever fn returns; other errors are raised as they are
+        '''
+        for attempt in range(CLIENT_CONFIG['write_retries'] + 1):
+            self._acquire()
+            ok = False
+            try:
+                result = fn(*args, **kwargs)
+                ok = True
+                return result
+            except Exception as e:
+                wait = rate_limit_wait(e)
+                if wait is None:
+                    # Not a rate limit: the write went through the limiter.
+                    ok = True
+                    raise
+                self.rate = rate_headers(CaseInsensitiveDict(
+                    getattr(getattr(e, "response", None), "headers", None)
+                    or getattr(e, "headers", None) or {})) or self.rate
+                self._release(False)
+                if self._back_off(wait):
+                    self.show(force=True)
+            finally:
+                if ok:
+                    self._budget()
+                    self._release(True)
+                    self.show()
+        raise RateLimited(f"still rate limited after {attempt} retries")
+
+    def status(self):
+        '''
+        Returns the status line: writes done, concurrency and budget.
+        '''
+        done = f"{self.done}/{self.total}" if self.total is not None else f"{self.done}"
+        line = f"{self.label}: {done} done, {int(self.window)}/{self.limit} concurrent"
+        if self.rate is not None:
+            line += f", rate limit {self.rate[0]}/{self.rate[1]} left"
+        pause = self.paused_until - time.time()
+        if pause > 0:
+            line += f", paused {pause:.0f}s"
+        if self.backoffs:
+            line += f", backed off {self.backoffs}x"
+        return line
+
+    def log(self, message):
+        '''
+        Prints a line to stdout without garbling the live status line.
+        '''
+        if self._live:
+            print("\r\033[K", end="", file=sys.stderr, flush=True)
+        print(message, flush=True)
+        if self._live:
+            self.show(force=True)
+
+    def show(self, force=False):
+        '''
+        Redraws the status line on stderr, at most a few times a second
+        (on a terminal; otherwise only forced updates are printed).
+        '''
+        now = time.time()
+        if not force and (not self._live or now - self._shown < 0.25):
+            return
+        self._shown = now
+        if self._live:
+            print("\r\033[K" + self.status(), end="", file=sys.stderr, flush=True)
+        else:
+            print(self.status(), file=sys.stderr)
@@ -8,19 +8,17 @@ import re
 import shutil
 import csv
 
-github_sfu_dict = {}
+from github2sfuid import roster
+
+_roster = None
 
 
 def fillmap(csv_file):
-    with open(csv_file) as studentcsv:
-        csv_reader = csv.DictReader(studentcsv)
-        for row in csv_reader:
-            key = row.pop('GithubID')
-            github_sfu_dict[key] = row
+    global _roster
+    _roster = roster.load(csv_file)
 
 
 def getsfuid(githubid):
-    if githubid in github_sfu_dict:
-        return github_sfu_dict[githubid]
-
-    return None
+    if _roster is None:
+        return None
+    return _roster.by_github(githubid)
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+import os
+import csv
+import pickle
+
+# Bump when the snapshot layout changes, so stale snapshots are rebuilt.
+SNAPSHOT_VERSION = 1
+
+_loaded = {}
+
+
+class Roster:
+    '''
+    The student roster (Students.csv), indexed by GithubID, SFUID and
+    SFUNUMBER. Lookups ignore case and surrounding whitespace, and return
+    the whole CSV row as a dict.
+    '''
+
+    def __init__(self, fields, rows, github, sfuid, number):
+        self.fields = fields
+        self.rows = rows
+        self.github = github
+        self.sfuid = sfuid
+        self.number = number
+
+    @classmethod
+    def from_csv(cls, csv_file):
+        with open(csv_file, newline="") as studentcsv:
+            csv_reader = csv.reader(studentcsv)
+            fields = next(csv_reader, [])
+            rows = [tuple(row) for row in csv_reader if any(row)]
+        indexes = []
+        for column in ("GithubID", "SFUID", "SFUNUMBER"):
+            index = {}
+            if column in fields:
+                at = fields.index(column)
+                for i, row in enumerate(rows):
+                    if at < len(row) and row[at].strip():
+                        index.setdefault(row[at].strip().lower(), i)
+            indexes.append(index)
+        return cls(fields, rows, *indexes)
+
+    def _row(self, index, key):
+        i = index.get(str(key).strip().lower())
+        if i is None:
+            return None
+        return dict(zip(self.fields, self.rows[i]))
+
+    def by_github(self, githubid):
+        '''
+        Returns the row of a GitHub id, or None.
+        '''
+        return self._row(self.github, githubid)
+
+    def by_sfuid(self, sfuid):
+        '''
+        Returns the row of an SFU id (username), or None.
+        '''
+        return self._row(self.sfuid, sfuid)
+
+    def by_number(self, number):
+        '''
+        Returns the row of an SFU student number, or None.
+        '''
+        return self._row(self.number, number)
+
+    def githubids(self):
+        '''
+        Returns the GitHub ids of the roster, as written in the CSV.
+        '''
+        return [self.rows[i][self.fields.index("GithubID")]
+                for i in self.github.values()]
+
+    def __len__(self):
+        return len(self.rows)
+
+
+def snapshot_path(csv_file):
+    '''
+    The snapshot of Students.csv is kept next to it, as .Students.csv.roster
+    '''
+    head, tail = os.path.split(os.path.abspath(csv_file))
+    return os.path.join(head, "." + tail + ".roster")
+
+
+def load(csv_file):
+    '''
+    Loads the roster once per process. The parsed roster and its indexes
+    are pickled next to the CSV and reused for as long as the CSV's
+    modification time and size are unchanged.
+
+    Parameters:
+        - Csv_file is the student CSV (First,Last,SFUID,SFUNUMBER,GithubID,...)
+
+    Returns:
+        - Roster
+    '''
+    path = os.path.abspath(csv_file)
+    st = os.stat(path)
+    stamp = (SNAPSHOT_VERSION, st.st_mtime_ns, st.st_size)
+    if path in _loaded and _loaded[path][0] == stamp:
+        return _loaded[path][1]
+
+    snapshot = snapshot_path(path)
+    roster = None
+    try:
+        with open(snapshot, "rb") as f:
+            saved_stamp, state = pickle.load(f)
+        if saved_stamp == stamp:
+            roster = Roster(*state)
+    except (OSError, EOFError, pickle.UnpicklingError, ValueError, TypeError):
+        pass
+
+    if roster is None:
+        roster = Roster.from_csv(path)
+        try:
+            with open(snapshot + ".tmp", "wb") as f:
+                pickle.dump((stamp, (roster.fields, roster.rows, roster.github,
+                                     roster.sfuid, roster.number)),
+                            f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(snapshot + ".tmp", snapshot)
+        except OSError:
+            pass
+
+    _loaded[path] = (stamp, roster)
+    return roster
@@ -8,19 +8,17 @@ import re
 import shutil
 import csv
 
-github_sfu_dict = {}
+from github2sfuid import roster
+
+_roster = None
 
 
 def fillmap(csv_file):
-    with open(csv_file) as studentcsv:
-        csv_reader = csv.DictReader(studentcsv)
-        for row in csv_reader:
-            key = row.pop('SFUID')
-            github_sfu_dict[key] = row
+    global _roster
+    _roster = roster.load(csv_file)
 
 
 def getgithubid(sfuid):
-    if sfuid in github_sfu_dict:
-        return github_sfu_dict[sfuid]
-
-    return None
+    if _roster is None:
+        return None
+    return _roster.by_sfuid(sfuid)
@@ -6,6 +6,13 @@ import configparser
 import re
 import shutil
 import csv
+import json
+import gzip
+import hashlib
+import collections
+from concurrent.futures import ProcessPoolExecutor
+
+from github2sfuid import roster
 
 
 class bcolors:
@@ -19,6 +26,186 @@ class bcolors:
     UNDERLINE = '\033[4m'
 
 
+# Lines of context kept before the first failure (or at the end of the log).
+CONTEXT_LINES = 20
+# Longer lines (e.g. a test printing in a loop without newlines) are cut.
+LINE_LIMIT = 1024
+# Failing test names listed per student.
+MAX_FAILING = 20
+
+_FAILURE = re.compile(r"\b(fail(ed|ure)?|error|abort(ed)?|segmentation fault|"
+                      r"timeout|timed out)\b", re.IGNORECASE)
+_FAILING_TEST = [
+    # [FAIL] test_name, FAILED: test_name, FAIL test_name
+    re.compile(r"^\s*(?:\[\s*FAIL(?:ED)?\s*\]|FAIL(?:ED)?:?)\s+([\w./:-]+)"),
+    # test_name: FAIL, test_name ... FAILED, test_name - failed
+    re.compile(r"^\s*([\w./-]+?)\s*(?::|\.{2,}|-)\s*FAIL(?:ED)?\b", re.IGNORECASE),
+]
+
+# Distinct failure lines hashed into a failure signature.
+MAX_SIGNATURE_LINES = 64
+
+_NORMALISE = [
+    (re.compile(r"(?:[\w.~-]*/)+([\w.-]+)"), r"\1"),               # paths
+    (re.compile(r"0x[0-9a-fA-F]+"), "ADDR"),                          # addresses
+    (re.compile(r"\d+(?:\.\d+)?\s*(?:ns|us|ms|s|sec|secs|seconds|minutes)\b"), "TIME"),
+    (re.compile(r"\d+"), "N"),
+    (re.compile(r"\s+"), " "),
+]
+
+
+def normalise(line, name):
+    '''
+    Strips what differs between students failing the same way: their repo
+    name, paths, addresses, timings and other numbers.
+    '''
+    line = line.replace(name, "REPO")
+    for regex, repl in _NORMALISE:
+        line = regex.sub(repl, line)
+    return line.strip()
+
+
+def read_grade(grade_file):
+    '''
+    Reads the score of a _Grade.json written by the CI scripts.
+
+    Parameters:
+        - Grade_file is the path of <repo>_Grade.json
+
+    Returns:
+        - Tuple of (total marks, dict of test -> (mark, comment)), or
+          (None, {}) if the file is missing or unreadable
+    '''
+    try:
+        with open(grade_file) as f:
+            grades = json.load(f)
+    except (OSError, ValueError):
+        return None, {}
+    tests = {}
+    for k, v in grades.items():
+        if isinstance(v, dict) and 'mark' in v:
+            tests[k] = (v['mark'], v.get('comment', ""))
+    return sum(mark for mark, _ in tests.values()
+               if isinstance(mark, (int, float))), tests
+
+
+def triage(log_file, context_lines=CONTEXT_LINES):
+    '''
+    Reads a CI log once, line by line, keeping only what a grader needs.
+    Memory stays bounded however long the log is: lines are cut at
+    LINE_LIMIT bytes and only context_lines of them are held at a time.
+
+    Parameters:
+        - Log_file is the path of <repo>.log, or <repo>.log.gz as filed by
+          gcassist.py run-local; its <repo>_Grade.json is looked up next to it
+        - Context_lines is the number of lines kept before the first failure
+
+    Returns:
+        - Dict with the failing test names, the context lines (before the
+          first failure, or the end of the log if nothing failed), the
+          number of lines read, the score and per-test marks, and the
+          failure signature: a hash of the distinct normalised failure
+          lines, equal for students whose logs fail the same way
+    '''
+    base = log_file[:-len(".gz")] if log_file.endswith(".gz") else log_file
+    base = base[:-len(".log")]
+    name = os.path.basename(base)
+    window = collections.deque(maxlen=context_lines)
+    signature = set()
+    context = None
+    failing = []
+    count = 0
+    with (gzip.open if log_file.endswith(".gz") else open)(log_file, "rb") as f:
+        while True:
+            line = f.readline(LINE_LIMIT)
+            if not line:
+                break
+            if not line.endswith(b"\n"):
+                # Skip the rest of an overlong line.
+                rest = line
+                while rest and not rest.endswith(b"\n"):
+                    rest = f.readline(LINE_LIMIT)
+                line += b" ..."
+            count += 1
+            text = line.decode("utf-8", "replace").rstrip()
+            window.append(text)
+            if not _FAILURE.search(text):
+                continue
+            if len(signature) < MAX_SIGNATURE_LINES:
+                signature.add(normalise(text, name))
+            if context is None:
+                context = list(window)
+            if len(failing) < MAX_FAILING:
+                for regex in _FAILING_TEST:
+                    m = regex.match(text)
+                    if m and m.group(1).lower() not in ("result", "status"):
+                        if m.group(1) not in failing:
+                            failing.append(m.group(1))
+                        break
+    score, tests = read_grade(base + "_Grade.json")
+    if not signature:
+        signature = {normalise(line, name) for line in window}
+    return {
+        'failing': failing,
+        'context': context if context is not None else list(window),
+        'at_failure': context is not None,
+        'lines': count,
+        'score': score,
+        'tests': tests,
+        'signature': hashlib.sha1("\n".join(sorted(signature)).encode()).hexdigest()[:12],
+    }
+
+
+def log_excerpt(result):
+    '''
+    Formats the failing tests and log lines of a triage result. Log lines
+    are indented in a code block, so none of them can start a new ###
+    section.
+    '''
+    entry = ""
+    if result['failing']:
+        entry += " - Failing tests: " + ", ".join(result['failing']) + "\n"
+    if result['context']:
+        where = "before the first failure" if result['at_failure'] else "at the end"
+        entry += f" - Log ({result['lines']} lines), {where}:\n\n```\n"
+        entry += "".join("    " + line.replace("```", "` ` `") + "\n"
+                         for line in result['context'])
+        entry += "```\n"
+    return entry
+
+
+def section(githubid, sfuid, result):
+    '''
+    Formats the grading sheet section of one student, prefilled from the
+    triage of their log.
+    '''
+    entry = "### " + githubid + "\n" + " - Fill in feedback for SFUID {}".format(sfuid) + "\n"
+    if result['score'] is not None:
+        entry += f" - Score: {result['score']}\n"
+        for test, (mark, comment) in result['tests'].items():
+            entry += f"   - {test}: {mark} {comment}".rstrip() + "\n"
+    return entry + log_excerpt(result)
+
+
+def cluster_section(githubids, result):
+    '''
+    Formats one section for a cluster of students whose logs have the same
+    failure signature. The header lists every member, and push-grade-sheet
+    gives each of them the comment under their own name, so the body must
+    not mention individual students: github ids are masked in the log
+    excerpt, and SFUIDs and scores go to FAIL_clusters.json instead.
+    '''
+    entry = "### " + ", ".join(githubids) + "\n"
+    entry += (f" - Fill in feedback for the {len(githubids)} students failing "
+              f"the same way (signature {result['signature']})\n")
+    context = []
+    for line in result['context']:
+        for githubid in githubids:
+            line = line.replace(githubid, "<githubid>")
+        context.append(line)
+    return entry + log_excerpt(dict(result, context=context))
+
+
 def print_help():
     '''
     Print help describing the syntax for how to use the program.
@@ -33,12 +220,26 @@ def print_help():
     [PATH]: Grade box. 
     Needs to have two folders [PATH]/PASS, [PATH]/FAIL with log files
     [assignment prefix] assignment name in classroom (e.g., assignment-1-) 
-    [CSV] Student CSV file collected from google forms >"""
+    [CSV] Student CSV file collected from google forms
+    --jobs=N number of logs read in parallel (default: number of CPUs)
+    --lines=N log lines kept before the first failure (default: {CONTEXT_LINES})
+    --cluster one FAIL.md section per failure signature instead of per student >"""
 
     print(f"Usage: {usage}")
 
 
 if __name__ == "__main__":
+    jobs = os.cpu_count()
+    context_lines = CONTEXT_LINES
+    cluster = False
+    for arg in [a for a in sys.argv if a.startswith("--")]:
+        if arg.startswith("--jobs="):
+            jobs = int(arg.split("=")[1])
+        elif arg.startswith("--lines="):
+            context_lines = int(arg.split("=")[1])
+        elif arg == "--cluster":
+            cluster = True
+        sys.argv.remove(arg)
     if len(sys.argv) < 4:
         print_help()
         sys.exit(1)
@@ -46,49 +247,56 @@ if __name__ == "__main__":
     project = sys.argv[1]
     githubprefix = sys.argv[2]
     studentcsv = sys.argv[3]
+    students = roster.load(studentcsv)
     project_dir = "{}".format(project)
-    PASS_dir = "{}/PASS".format(project)
-    FAIL_dir = "{}/FAIL".format(project)
-
-    PASSFILE = open("PASS.md", "w")
-    FAILFILE = open("FAIL.md", "w")
-
-    if os.path.isdir(PASS_dir):
-        for filename in os.listdir(PASS_dir):
-            if filename.endswith(".log"):
-                githubid = filename.replace(
-                    githubprefix, "").replace(".log", "")
-                with open(studentcsv) as csv_file:
-                    result = {}
-                    csv_reader = csv.DictReader(csv_file)
-                    for row in csv_reader:
-                        key = row.pop('GithubID')
-                        result[key] = row
-                    if githubid in result.keys():
-                        entry = "### " + githubid + "\n" + " - Fill in feedback for SFUID {}".format(
-                                result[githubid]['SFUID'])+"\n"
-                        PASSFILE.write(entry)
-                    else:
-                        print(bcolors.WARNING + githubid +
-                              " not found" + bcolors.ENDC)
-    if os.path.isdir(FAIL_dir):
-        for filename in os.listdir(FAIL_dir):
-            if filename.endswith(".log"):
-                githubid = filename.replace(
-                    githubprefix, "").replace(".log", "")
-                with open(studentcsv) as csv_file:
-                    result = {}
-                    csv_reader = csv.DictReader(csv_file)
-                    for row in csv_reader:
-                        key = row.pop('GithubID')
-                        result[key] = row
-                    if githubid in result.keys():
-                        entry = "### " + githubid + "\n" + " - Fill in feedback for SFUID {}".format(
-                                result[githubid]['SFUID'])+"\n"
-                        FAILFILE.write(entry)
+
+    # Each log is read once, by a pool of processes; sections are written
+    # in file name order as their results come in.
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        for kind in ("PASS", "FAIL"):
+            kind_dir = "{}/{}".format(project, kind)
+            with open(kind + ".md", "w") as sheet:
+                if not os.path.isdir(kind_dir):
+                    continue
+                logs = sorted(filename for filename in os.listdir(kind_dir)
+                              if filename.endswith((".log", ".log.gz")))
+                results = pool.map(
+                    triage, [os.path.join(kind_dir, filename) for filename in logs],
+                    [context_lines] * len(logs))
+                if kind == "FAIL" and cluster:
+                    clusters = {}
+                    for filename, result in zip(logs, results):
+                        githubid = filename.replace(
+                            githubprefix, "").replace(".gz", "").replace(".log", "")
+                        row = students.by_github(githubid)
+                        if row is None:
+                            print(bcolors.WARNING + githubid +
+                                  " not found" + bcolors.ENDC)
+                            continue
+                        clusters.setdefault(result['signature'], []).append(
+                            (githubid, row['SFUID'], result))
+                    members = {}
+                    for signature, group in sorted(clusters.items(),
+                                                   key=lambda c: -len(c[1])):
+                        if len(group) == 1:
+                            sheet.write(section(*group[0]))
+                        else:
+                            sheet.write(cluster_section([g for g, _, _ in group],
+                                                        group[0][2]))
+                        members[signature] = [
+                            {'githubid': g, 'sfuid': sfuid, 'score': r['score']}
+                            for g, sfuid, r in group]
+                    with open("FAIL_clusters.json", "w") as f:
+                        json.dump(members, f, indent=2)
+                    print(f"{sum(len(g) for g in clusters.values())} failing "
+                          f"students in {len(clusters)} clusters, see FAIL.md")
+                    continue
+                for filename, result in zip(logs, results):
+                    githubid = filename.replace(
+                        githubprefix, "").replace(".gz", "").replace(".log", "")
+                    row = students.by_github(githubid)
+                    if row is not None:
+                        sheet.write(section(githubid, row['SFUID'], result))
                     else:
                         print(bcolors.WARNING + githubid +
                               " not found" + bcolors.ENDC)
-
-    PASSFILE.close()
-    FAILFILE.close()
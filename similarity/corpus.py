@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+
+import os
+import dbm
+import json
+import random
+
+from similarity import winnow
+
+# MinHash signature length, split into BANDS bands of ROWS rows for LSH.
+# Two submissions whose fingerprint sets have Jaccard similarity s land in a
+# common bucket with probability 1 - (1 - s^ROWS)^BANDS: about 0.5 at
+# s = 0.15 and above 0.99 from s = 0.4.
+ROWS = 2
+BANDS = 32
+_PRIME = (1 << 61) - 1
+_rng = random.Random(295)
+_PERMUTATIONS = [(_rng.randrange(1, _PRIME), _rng.randrange(_PRIME))
+                 for _ in range(ROWS * BANDS)]
+
+
+def minhash(hashes):
+    '''
+    MinHash signature of a set of fingerprint hashes.
+
+    Parameters:
+        - Hashes is a non-empty set of fingerprint hashes
+
+    Returns:
+        - List of ROWS * BANDS minima, one per hash permutation
+    '''
+    return [min((a * h + b) % _PRIME for h in hashes)
+            for a, b in _PERMUTATIONS]
+
+
+def band_keys(signature):
+    '''
+    LSH bucket keys of a signature, one per band.
+    '''
+    return [f"b:{i}:" + ",".join(str(x) for x in signature[i * ROWS:(i + 1) * ROWS])
+            for i in range(BANDS)]
+
+
+class Corpus:
+    '''
+    Persistent, append-only store of past submissions' fingerprints.
+
+    records.jsonl holds one line per submission (its id and fingerprints)
+    and is only ever appended to. The index dbm maps each id to its line offset
+    and each LSH bucket to the ids in it, so a lookup reads BANDS buckets
+    and the candidate records, no matter how many terms are archived.
+    common.jsonl collects the starter code fingerprints of every archived
+    cohort, which are left out of lookups.
+    '''
+
+    def __init__(self, path):
+        os.makedirs(path, exist_ok=True)
+        self.records = os.path.join(path, "records.jsonl")
+        self.common_path = os.path.join(path, "common.jsonl")
+        self.index = dbm.open(os.path.join(path, "index"), "c")
+
+    def common(self):
+        '''
+        Returns the set of starter code fingerprints of all archived cohorts.
+        '''
+        hashes = set()
+        if os.path.isfile(self.common_path):
+            with open(self.common_path) as f:
+                for line in f:
+                    hashes.update(json.loads(line))
+        return hashes
+
+    def add_common(self, hashes):
+        with open(self.common_path, "a") as f:
+            f.write(json.dumps(sorted(hashes)) + "\n")
+
+    def close(self):
+        self.index.close()
+
+    def __contains__(self, id):
+        return ("o:" + id).encode() in self.index
+
+    def __len__(self):
+        return sum(1 for key in self.index.keys() if key.startswith(b"o:"))
+
+    def add(self, id, fingerprints):
+        '''
+        Appends a submission and indexes it; ids already present are skipped.
+
+        Parameters:
+            - Id names the submission, e.g. 2024-fall/githubid
+            - Fingerprints is its list of (hash, file, first line, last line)
+
+        Returns:
+            - True if the submission was added
+        '''
+        hashes = {h for h, _, _, _ in fingerprints}
+        if id in self or not hashes:
+            return False
+        with open(self.records, "a") as f:
+            offset = f.tell()
+            f.write(json.dumps({'id': id, 'fingerprints': fingerprints}) + "\n")
+        self.index["o:" + id] = str(offset)
+        for key in band_keys(minhash(hashes)):
+            ids = self.index.get(key, b"").decode()
+            self.index[key] = (ids + "\n" + id).strip("\n")
+        return True
+
+    def get(self, id):
+        '''
+        Reads the fingerprints of an archived submission.
+        '''
+        with open(self.records) as f:
+            f.seek(int(self.index["o:" + id]))
+            return [tuple(fp) for fp in json.loads(f.readline())['fingerprints']]
+
+    def candidates(self, hashes):
+        '''
+        Looks up the archived submissions sharing an LSH bucket with a set
+        of fingerprint hashes.
+
+        Parameters:
+            - Hashes is a set of fingerprint hashes
+
+        Returns:
+            - Set of ids
+        '''
+        found = set()
+        if hashes:
+            for key in band_keys(minhash(hashes)):
+                ids = self.index.get(key)
+                if ids:
+                    found.update(ids.decode().split("\n"))
+        return found
+
+
+def drop_common(docs, ignore=frozenset(), max_share=0.1):
+    '''
+    Removes fingerprints found in more than max_share of a cohort, and in
+    more than winnow.MIN_COMMON submissions (starter code), which would
+    otherwise put every submission in the same buckets. A fingerprint shared
+    by a few students of a small class is kept: it may be a copy ring, and
+    archive() would exclude it from every later lookup.
+
+    Parameters:
+        - Docs is a dict of submission name -> fingerprints
+        - Ignore is a set of hashes to remove as well
+        - Max_share is the fraction used by winnow.compare (see
+          winnow.common_limit)
+
+    Returns:
+        - Tuple of (dict of submission name -> remaining fingerprints,
+          set of the hashes found to be common in the cohort)
+    '''
+    index = winnow.build_index(docs)
+    limit = winnow.common_limit(len(docs), max_share)
+    common = {h for h, names in index.items() if len(names) > limit}
+    drop = common | set(ignore)
+    return ({name: [fp for fp in fps if fp[0] not in drop]
+             for name, fps in docs.items()}, common)
+
+
+def archive(corpus, docs, term):
+    '''
+    Adds a cohort to the corpus as <term>/<name>. Submissions archived
+    before are left alone, so this only indexes what is new.
+
+    Parameters:
+        - Corpus is an open Corpus
+        - Docs is a dict of submission name -> fingerprints
+        - Term labels the cohort, e.g. 2024-fall
+
+    Returns:
+        - Number of submissions added
+    '''
+    known = corpus.common()
+    docs, common = drop_common(docs, known)
+    if common - known:
+        corpus.add_common(common - known)
+    added = 0
+    for name, fps in docs.items():
+        if corpus.add(f"{term}/{name}", fps):
+            added += 1
+    return added
+
+
+def search(corpus, docs, min_shared=5, exclude_term=None):
+    '''
+    Checks a cohort against every archived submission through the LSH
+    index, then confirms each candidate on the exact fingerprints.
+    Starter code fingerprints of this and the archived cohorts are left out.
+
+    Parameters:
+        - Corpus is an open Corpus
+        - Docs is a dict of submission name -> fingerprints
+        - Min_shared is the number of shared fingerprints to report a pair
+        - Exclude_term skips archived submissions of that term (the
+          cohort itself, if it was archived already)
+
+    Returns:
+        - List of match dicts, as returned by winnow.compare, with the
+          archived submission as 'b'
+    '''
+    matches = []
+    docs, _ = drop_common(docs, corpus.common())
+    for name, fps in docs.items():
+        hashes = {h for h, _, _, _ in fps}
+        if not hashes:
+            continue
+        for id in corpus.candidates(hashes):
+            if exclude_term and id.startswith(exclude_term + "/"):
+                continue
+            past = corpus.get(id)
+            past_hashes = {h for h, _, _, _ in past}
+            both = hashes & past_hashes
+            if len(both) < min_shared:
+                continue
+            matches.append({
+                'a': name,
+                'b': id,
+                'shared': len(both),
+                'percent_a': round(100 * len(both) / len(hashes)),
+                'percent_b': round(100 * len(both) / len(past_hashes)),
+                'lines_a': winnow.merge_ranges((f, s, e) for h, f, s, e in fps if h in both),
+                'lines_b': winnow.merge_ranges((f, s, e) for h, f, s, e in past if h in both),
+            })
+    matches.sort(key=lambda m: (max(m['percent_a'], m['percent_b']),
+                                m['shared']), reverse=True)
+    return matches
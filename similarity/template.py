@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import difflib
+import hashlib
+import subprocess
+
+
+class TemplateSubtractor:
+    '''
+    Separates starter code from student-authored lines.
+
+    Every staged file is diffed against the template file with the same
+    name, taken from a bare mirror of the template repo (see
+    gcassist.template_store). The template files are extracted once per
+    template commit, and the template lines found in each file are cached
+    by template commit plus file contents, so a file is only diffed again
+    when it or the template changes.
+    '''
+
+    def __init__(self, store, cache_dir):
+        '''
+        Parameters:
+            - Store is the path of the bare template mirror
+            - Cache_dir is where template files and diff results are kept
+        '''
+        self.version = subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=store,
+            capture_output=True, text=True, check=True).stdout.strip()
+        self.cache_dir = os.path.join(cache_dir, self.version)
+        self.files = self._extract(store)
+
+    def _extract(self, store):
+        '''
+        Returns a dict of file name -> template text, extracting the files
+        of the template commit into the cache on first use. Files are keyed
+        by base name, like the Mossbox staging; the first path wins.
+        '''
+        files_dir = os.path.join(self.cache_dir, "files")
+        if not os.path.isdir(files_dir):
+            os.makedirs(files_dir + ".tmp", exist_ok=True)
+            paths = subprocess.run(
+                ["git", "ls-tree", "-r", "--name-only", self.version],
+                cwd=store, capture_output=True, text=True,
+                check=True).stdout.splitlines()
+            for path in sorted(paths, reverse=True):
+                blob = subprocess.run(
+                    ["git", "show", f"{self.version}:{path}"], cwd=store,
+                    capture_output=True, check=True).stdout
+                with open(os.path.join(files_dir + ".tmp",
+                                       os.path.basename(path)), "wb") as f:
+                    f.write(blob)
+            os.replace(files_dir + ".tmp", files_dir)
+
+        files = {}
+        for name in os.listdir(files_dir):
+            with open(os.path.join(files_dir, name), errors="replace") as f:
+                files[name] = f.read()
+        return files
+
+    def template_lines(self, name, text):
+        '''
+        Finds the lines of a file that come unchanged from the template.
+
+        Parameters:
+            - Name is the file's base name
+            - Text is its contents
+
+        Returns:
+            - Set of 1-based line numbers; empty if the template has no
+              file of that name
+        '''
+        if name not in self.files:
+            return set()
+        key = hashlib.sha256(name.encode() + b"\0" + text.encode()).hexdigest()
+        path = os.path.join(self.cache_dir, "lines", key)
+        if os.path.isfile(path):
+            with open(path) as f:
+                return set(json.load(f))
+
+        ours = text.splitlines()
+        theirs = self.files[name].splitlines()
+        matcher = difflib.SequenceMatcher(None, theirs, ours, autojunk=False)
+        lines = set()
+        for _, j, size in matcher.get_matching_blocks():
+            lines.update(range(j + 1, j + size + 1))
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(sorted(lines), f)
+        return lines
+
+    def subtract(self, name, text):
+        '''
+        Blanks out the template lines of a file. Line numbers are kept, so
+        matches and diagnostics still point at the right lines.
+
+        Parameters:
+            - Name is the file's base name
+            - Text is its contents
+
+        Returns:
+            - The student-authored text
+        '''
+        lines = self.template_lines(name, text)
+        if not lines:
+            return text
+        return "\n".join("" if n in lines else l
+                         for n, l in enumerate(text.splitlines(), 1)) + "\n"
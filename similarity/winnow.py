@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import sys
+import hashlib
+import itertools
+import collections
+
+# Winnowing parameters: k is the k-gram length in tokens, w the window.
+# Any match of at least k + w - 1 tokens is guaranteed to share a fingerprint.
+K = 12
+W = 8
+
+# A fingerprint is only ever common if more than this many submissions
+# share it, whatever the cohort size (like moss -m 10). Starter code of a
+# small class is left to template subtraction.
+MIN_COMMON = 10
+
+C_KEYWORDS = frozenset("""
+    auto break case char const continue default do double else enum extern
+    float for goto if inline int long register restrict return short signed
+    sizeof static struct switch typedef union unsigned void volatile while
+    _Bool NULL
+""".split())
+
+ASM_SUFFIXES = (".s", ".S", ".asm")
+
+_TOKEN = re.compile(r"""
+      (?P<skip>\s+|//[^\n]*|/\*.*?\*/|\#[^\n]*)
+    | (?P<string>"(?:\\.|[^"\\\n])*"|'(?:\\.|[^'\\\n])*')
+    | (?P<number>0[xX][0-9a-fA-F]+|\d+(?:\.\d*)?(?:[eE][+-]?\d+)?[uUlLfF]*)
+    | (?P<word>[A-Za-z_.][A-Za-z0-9_.]*)
+    | (?P<op>->|\+\+|--|<<=?|>>=?|[<>=!&|^+\-*/%]=|&&|\|\||\S)
+""", re.VERBOSE | re.DOTALL)
+
+
+def tokenize(text, asm=False):
+    '''
+    Splits C or assembly source into normalised tokens.
+
+    Comments, whitespace and preprocessor lines (or # comments in assembly)
+    are dropped. Literals become N or S. In C, identifiers that are not
+    keywords become V, so renaming variables does not hide a match;
+    in assembly, mnemonics and registers are kept as written.
+
+    Parameters:
+        - Text is the source code
+        - Asm selects assembly rather than C rules
+
+    Returns:
+        - List of (token, line number) tuples
+    '''
+    tokens = []
+    line = 1
+    for m in _TOKEN.finditer(text):
+        kind = m.lastgroup
+        value = m.group()
+        if kind == "string":
+            tokens.append(("S", line))
+        elif kind == "number":
+            tokens.append(("N", line))
+        elif kind == "word":
+            if asm:
+                tokens.append((value.lower(), line))
+            elif "." in value:
+                # Member access, e.g. a.b, is not a single C identifier.
+                for part in value.split("."):
+                    if part:
+                        tokens.append((part if part in C_KEYWORDS else "V", line))
+                    tokens.append((".", line))
+                tokens.pop()
+            else:
+                tokens.append((value if value in C_KEYWORDS else "V", line))
+        elif kind == "op":
+            tokens.append((value, line))
+        line += value.count("\n")
+    return tokens
+
+
+_MOD = (1 << 61) - 1
+_BASE = 1000003
+_token_ids = {}
+
+
+def token_id(token):
+    '''
+    Stable 60-bit number for a token, so fingerprints are the same across
+    runs and machines and can be stored.
+    '''
+    if token not in _token_ids:
+        digest = hashlib.blake2b(token.encode(), digest_size=8).digest()
+        _token_ids[token] = int.from_bytes(digest, "big") >> 4
+    return _token_ids[token]
+
+
+def kgram_hashes(words, k):
+    '''
+    Rolling (Karp-Rabin) hashes of every k-gram of a token list.
+
+    Parameters:
+        - Words is the list of tokens
+        - K is the k-gram length
+
+    Returns:
+        - List of len(words) - k + 1 hashes
+    '''
+    if len(words) < k:
+        return []
+    top = pow(_BASE, k - 1, _MOD)
+    ids = [token_id(t) for t in words]
+    h = 0
+    for x in ids[:k]:
+        h = (h * _BASE + x) % _MOD
+    hashes = [h]
+    for i in range(k, len(ids)):
+        h = ((h - ids[i - k] * top) * _BASE + ids[i]) % _MOD
+        hashes.append(h)
+    return hashes
+
+
+def winnow(tokens, k=K, w=W):
+    '''
+    Selects the winnowing fingerprints of a token stream: the minimum
+    k-gram hash of every window of w consecutive hashes (rightmost on
+    ties), each recorded once.
+
+    Parameters:
+        - Tokens is a list of (token, line number) from tokenize
+        - K is the k-gram length
+        - W is the window size
+
+    Returns:
+        - List of (hash, first line, last line) tuples
+    '''
+    hashes = kgram_hashes([t for t, _ in tokens], k)
+    fingerprints = []
+    # Positions of increasing hashes; the front is the current minimum.
+    window = collections.deque()
+    selected = -1
+    for pos, h in enumerate(hashes):
+        while window and hashes[window[-1]] >= h:
+            window.pop()
+        window.append(pos)
+        if window[0] <= pos - w:
+            window.popleft()
+        if pos >= w - 1 or pos == len(hashes) - 1:
+            low = window[0]
+            if low != selected:
+                selected = low
+                fingerprints.append((hashes[low], tokens[low][1],
+                                     tokens[low + k - 1][1]))
+    return fingerprints
+
+
+def fingerprint_files(paths, k=K, w=W):
+    '''
+    Fingerprints the files of one submission.
+
+    Parameters:
+        - Paths is a dict of display name -> path of each file
+        - K and W are the winnowing parameters
+
+    Returns:
+        - List of (hash, file, first line, last line) tuples
+    '''
+    fingerprints = []
+    for name, path in sorted(paths.items()):
+        with open(path, errors="replace") as f:
+            tokens = tokenize(f.read(), asm=name.endswith(ASM_SUFFIXES))
+        for h, start, end in winnow(tokens, k, w):
+            fingerprints.append((h, name, start, end))
+    return fingerprints
+
+
+def fingerprint_dir(root, k=K, w=W):
+    '''
+    Fingerprints every submission of a staging directory laid out like
+    Mossbox/<githubid>/<files>.
+
+    Parameters:
+        - Root is the staging directory
+        - K and W are the winnowing parameters
+
+    Returns:
+        - Dict of submission name -> fingerprints (see fingerprint_files)
+    '''
+    docs = {}
+    for student in sorted(os.listdir(root)):
+        student_dir = os.path.join(root, student)
+        if not os.path.isdir(student_dir):
+            continue
+        paths = {}
+        for dirpath, dirs, files in os.walk(student_dir):
+            for file in files:
+                path = os.path.join(dirpath, file)
+                paths[os.path.relpath(path, student_dir)] = path
+        docs[student] = fingerprint_files(paths, k, w)
+    return docs
+
+
+def merge_ranges(ranges):
+    '''
+    Merges overlapping or adjacent line ranges per file.
+
+    Parameters:
+        - Ranges is an iterable of (file, first line, last line)
+
+    Returns:
+        - Sorted list of merged (file, first line, last line)
+    '''
+    merged = []
+    for file, start, end in sorted(ranges):
+        if merged and merged[-1][0] == file and start <= merged[-1][2] + 1:
+            merged[-1] = (file, merged[-1][1], max(end, merged[-1][2]))
+        else:
+            merged.append((file, start, end))
+    return merged
+
+
+def build_index(docs):
+    '''
+    Builds the inverted fingerprint index.
+
+    Parameters:
+        - Docs is a dict of submission name -> fingerprints
+
+    Returns:
+        - Dict of hash -> set of submission names containing it
+    '''
+    index = {}
+    for name, fingerprints in docs.items():
+        for h, _, _, _ in fingerprints:
+            index.setdefault(h, set()).add(name)
+    return index
+
+
+def common_limit(n_docs, max_share=0.1):
+    '''
+    Returns the number of submissions a fingerprint may appear in before it
+    is considered common: max_share of the cohort, but at least MIN_COMMON.
+    '''
+    return max(MIN_COMMON, int(n_docs * max_share))
+
+
+def compare(docs, max_share=0.1, min_shared=5, ignore=frozenset()):
+    '''
+    Ranks pairs of submissions by the fingerprints they share.
+
+    Only pairs that share at least one fingerprint are ever looked at: the
+    work is proportional to the postings of the inverted index, not to
+    the number of pairs. Fingerprints found in more than max_share of the
+    submissions, and in more than MIN_COMMON of them (starter code,
+    boilerplate), are ignored, like moss -m.
+
+    Parameters:
+        - Docs is a dict of submission name -> fingerprints
+        - Max_share is the fraction of submissions above which a
+          fingerprint is considered common
+        - Min_shared is the number of shared fingerprints to report a pair
+        - Ignore is a set of hashes to skip, e.g. from the template
+
+    Returns:
+        - List of match dicts sorted by decreasing similarity, with the two
+          names, the shared count, the percentage of each side that matches
+          and the merged line ranges on each side
+    '''
+    index = build_index(docs)
+    limit = common_limit(len(docs), max_share)
+    common = {h for h, names in index.items() if len(names) > limit}
+    common |= set(ignore)
+
+    shared = {}
+    for h, names in index.items():
+        if len(names) < 2 or h in common:
+            continue
+        for pair in itertools.combinations(sorted(names), 2):
+            shared[pair] = shared.get(pair, 0) + 1
+
+    sizes = {name: len({h for h, _, _, _ in fps} - common)
+             for name, fps in docs.items()}
+    matches = []
+    for (a, b), count in shared.items():
+        if count < min_shared:
+            continue
+        hashes_a = {h for h, _, _, _ in docs[a]}
+        both = hashes_a.intersection(h for h, _, _, _ in docs[b]) - common
+        matches.append({
+            'a': a,
+            'b': b,
+            'shared': count,
+            'percent_a': round(100 * count / max(1, sizes[a])),
+            'percent_b': round(100 * count / max(1, sizes[b])),
+            'lines_a': merge_ranges((f, s, e) for h, f, s, e in docs[a] if h in both),
+            'lines_b': merge_ranges((f, s, e) for h, f, s, e in docs[b] if h in both),
+        })
+    matches.sort(key=lambda m: (max(m['percent_a'], m['percent_b']),
+                                m['shared']), reverse=True)
+    return matches
+
+
+def write_report(matches, out, top=None):
+    '''
+    Writes a ranked, human readable match report.
+
+    Parameters:
+        - Matches is the list from compare
+        - Out is an open text file
+        - Top limits the report to the first matches
+
+    Returns:
+        - None
+    '''
+    for rank, m in enumerate(matches[:top], 1):
+        print(f"{rank:4}. {m['a']} ({m['percent_a']}%)  {m['b']} "
+              f"({m['percent_b']}%)  {m['shared']} fingerprints", file=out)
+        for side in ('a', 'b'):
+            ranges = ", ".join(f"{f}:{s}-{e}" for f, s, e in m['lines_' + side])
+            print(f"        {m[side]}: {ranges}", file=out)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(f"Usage: {sys.argv[0]} <staging dir, e.g. Mossbox> [top]")
+        sys.exit(1)
+    matches = compare(fingerprint_dir(sys.argv[1]))
+    top = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    write_report(matches, sys.stdout, top)
@@ -3,12 +3,15 @@
 import os
 import sys
 import subprocess
-from github import Github, GithubException
+from github import GithubException
 import configparser
 import re
 import shutil
 import csv
 
+from github2sfuid import roster
+import ghclient
+
 
 class bcolors:
     HEADER = '\033[95m'
@@ -21,15 +24,12 @@ class bcolors:
     UNDERLINE = '\033[4m'
 
 
-github_sfu_dict = {}
+students = None
 
 
 def fillmap(csv_file):
-    with open(csv_file) as studentcsv:
-        csv_reader = csv.DictReader(studentcsv)
-        for row in csv_reader:
-            key = row.pop('GithubID')
-            github_sfu_dict[key] = row
+    global students
+    students = roster.load(csv_file)
 
 
 # Try to get it from system environment variable (On Linux/macOS you have to create it on $HOME/.bash_profile or .bashrc)
@@ -52,8 +52,9 @@ GIT_GUD_CONFIG = {
 
 
 def print_sfu_email(githubid):
-    if (githubid in github_sfu_dict.keys()):
-        print(github_sfu_dict[githubid]["SFUID"]+"@sfu.ca"+",")
+    row = students.by_github(githubid)
+    if row is not None:
+        print(row["SFUID"]+"@sfu.ca"+",")
     else:
         print(bcolors.WARNING + githubid +
               " not found" + bcolors.ENDC)
@@ -112,17 +113,17 @@ def track_matching(project, organization):
     Returns:
         - None
     '''
-    g = Github(GIT_GUD_CONFIG['key'])
+    g = ghclient.github(GIT_GUD_CONFIG['key'])
     students_with_repos = set()
     students_with_LT2 = set()
     for repo in g.get_user().get_repos():
         if is_matching(repo, project, organization):
             #            print(repo.name, repo.get_commits().totalCount)
             githubid = repo.name.replace(project, "")
-            students_with_repos.add(githubid)
+            students_with_repos.add(githubid.lower())
             if (repo.get_commits().totalCount <= 2):
                 students_with_LT2.add(githubid)
-    allstudents = github_sfu_dict.keys()
+    allstudents = {x.lower() for x in students.githubids()}
     students_without_repos = set(
         allstudents).difference(students_with_repos)
     print("Students with few commits")
@@ -1,11 +1,12 @@
 import os
 import sys
 import subprocess
-from github import Github, GithubException, Repository
+from github import GithubException, Repository
 import configparser
 import re
 import shutil
 import csv
+import ghclient
 
 
 class bcolors:
@@ -91,7 +92,7 @@ def track_matching(project, organization):
     Returns:
         - None
     '''
-    g = Github(GIT_GUD_CONFIG['key'])
+    g = ghclient.github(GIT_GUD_CONFIG['key'])
     repo = g.get_repo("SFU-CMPT-300/TestCI")
     repo.create_repository_dispatch("grading")
     print(repo.name)